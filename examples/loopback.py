@@ -12,6 +12,8 @@ from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 
 
 class Loopback(LoggingMixIn, Operations):
+    write_memoryview = True
+
     def __init__(self, root):
         self.root = realpath(root)
         self.rwlock = Lock()
@@ -39,10 +41,7 @@ class Loopback(LoggingMixIn, Operations):
             return os.fsync(fh)
 
     def getattr(self, path, fh=None):
-        st = os.lstat(path)
-        return dict((key, getattr(st, key)) for key in (
-            'st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime',
-            'st_nlink', 'st_size', 'st_uid'))
+        return os.lstat(path)
 
     getxattr = None
 
@@ -59,6 +58,10 @@ class Loopback(LoggingMixIn, Operations):
             os.lseek(fh, offset, 0)
             return os.read(fh, size)
 
+    if hasattr(os, 'preadv'):
+        def read_into(self, path, buf, offset, fh):
+            return os.preadv(fh, [buf], offset)
+
     def readdir(self, path, fh):
         return ['.', '..'] + os.listdir(path)
 
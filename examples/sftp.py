@@ -6,7 +6,7 @@ import paramiko
 
 from errno import ENOENT
 
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
+from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, AttrCacheMixIn
 
 
 class SFTP(LoggingMixIn, Operations):
@@ -91,6 +91,10 @@ class SFTP(LoggingMixIn, Operations):
         return len(data)
 
 
+class CachedSFTP(AttrCacheMixIn, SFTP):
+    'SFTP with getattr results cached to save an lstat round trip each'
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
@@ -106,7 +110,7 @@ if __name__ == '__main__':
             args.login, _, args.host = args.host.partition('@')
 
     fuse = FUSE(
-        SFTP(args.host, username=args.login),
+        CachedSFTP(args.host, username=args.login),
         args.mount,
         foreground=True,
         nothreads=True,
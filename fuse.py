@@ -18,13 +18,22 @@ from __future__ import print_function, absolute_import, division
 import ctypes
 import errno
 import logging
+import mmap
 import os
+import posixpath
+import struct
+import time
 import warnings
 
+from collections import OrderedDict, namedtuple
 from ctypes.util import find_library
+from hashlib import sha1
+from itertools import count, islice
+from operator import itemgetter, methodcaller
 from platform import machine, system
 from signal import signal, SIGINT, SIG_DFL
-from stat import S_IFDIR
+from stat import S_IFDIR, S_ISREG
+from threading import BoundedSemaphore, Event, Lock, Thread
 from traceback import print_exc
 
 
@@ -43,11 +52,36 @@ except ImportError:
         newfunc.keywords = keywords
         return newfunc
 
+try:
+    from functools import lru_cache
+except ImportError:
+    lru_cache = None
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
 try:
     basestring
 except NameError:
     basestring = str
 
+try:
+    long
+except NameError:
+    long = int
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    _monotonic = time.time
+
 log = logging.getLogger("fuse")
 _system = system()
 _machine = machine()
@@ -75,49 +109,117 @@ else:
     class c_timespec(ctypes.Structure):
         _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
 
+# Special tv_nsec values passed to utimens when flag_utime_omit_ok is set
+if _system in ('Darwin', 'FreeBSD'):
+    UTIME_NOW = -1
+    UTIME_OMIT = -2
+else:
+    UTIME_NOW = (1 << 30) - 1
+    UTIME_OMIT = (1 << 30) - 2
+
 class c_utimbuf(ctypes.Structure):
     _fields_ = [('actime', c_timespec), ('modtime', c_timespec)]
 
 class c_stat(ctypes.Structure):
     pass    # Platform dependent
 
-_libfuse_path = os.environ.get('FUSE_LIBRARY_PATH')
-if not _libfuse_path:
-    if _system == 'Darwin':
-        # libfuse dependency
-        _libiconv = ctypes.CDLL(find_library('iconv'), ctypes.RTLD_GLOBAL)
+# Well known names of libfuse, tried before the (slow) find_library
+_LIBFUSE_SONAMES = ('libfuse.so.2', 'libfuse.so')
 
-        _libfuse_path = (find_library('fuse4x') or find_library('osxfuse') or
-                         find_library('fuse'))
-    elif _system == 'Windows':
-        try:
-            import _winreg as reg
-        except ImportError:
-            import winreg as reg
-        def Reg32GetValue(rootkey, keyname, valname):
-            key, val = None, None
+def _open_libfuse():
+    path = os.environ.get('FUSE_LIBRARY_PATH')
+    if not path:
+        if _system == 'Darwin':
+            global _libiconv
+            # libfuse dependency
+            _libiconv = ctypes.CDLL(find_library('iconv'), ctypes.RTLD_GLOBAL)
+
+            path = (find_library('fuse4x') or find_library('osxfuse') or
+                    find_library('fuse'))
+        elif _system == 'Windows':
             try:
-                key = reg.OpenKey(rootkey, keyname, 0, reg.KEY_READ | reg.KEY_WOW64_32KEY)
-                val = str(reg.QueryValueEx(key, valname)[0])
-            except WindowsError:
-                pass
-            finally:
-                if key is not None:
-                    reg.CloseKey(key)
-            return val
-        _libfuse_path = Reg32GetValue(reg.HKEY_LOCAL_MACHINE, r"SOFTWARE\WinFsp", r"InstallDir")
-        if _libfuse_path:
-            _libfuse_path += r"bin\winfsp-%s.dll" % ("x64" if sys.maxsize > 0xffffffff else "x86")
-    else:
-        _libfuse_path = find_library('fuse')
+                import _winreg as reg
+            except ImportError:
+                import winreg as reg
+            def Reg32GetValue(rootkey, keyname, valname):
+                key, val = None, None
+                try:
+                    key = reg.OpenKey(rootkey, keyname, 0, reg.KEY_READ | reg.KEY_WOW64_32KEY)
+                    val = str(reg.QueryValueEx(key, valname)[0])
+                except WindowsError:
+                    pass
+                finally:
+                    if key is not None:
+                        reg.CloseKey(key)
+                return val
+            path = Reg32GetValue(reg.HKEY_LOCAL_MACHINE, r"SOFTWARE\WinFsp", r"InstallDir")
+            if path:
+                path += r"bin\winfsp-%s.dll" % ("x64" if sys.maxsize > 0xffffffff else "x86")
+        else:
+            for soname in _LIBFUSE_SONAMES:
+                try:
+                    return ctypes.CDLL(soname)
+                except OSError:
+                    pass
 
-if not _libfuse_path:
-    raise EnvironmentError('Unable to find libfuse')
-else:
-    _libfuse = ctypes.CDLL(_libfuse_path)
+            path = find_library('fuse')
+
+    if not path:
+        raise EnvironmentError('Unable to find libfuse')
+
+    return ctypes.CDLL(path)
+
+_libfuse = None
+_libfuse_lock = Lock()
+
+def _load_libfuse():
+    '''
+    Returns libfuse, which is only looked up on first use so that importing
+    this module stays cheap.
+    '''
 
-if _system == 'Darwin' and hasattr(_libfuse, 'macfuse_version'):
-    _system = 'Darwin-MacFuse'
+    global _libfuse
+    with _libfuse_lock:
+        if _libfuse is None:
+            _libfuse = _open_libfuse()
+        _libfuse.fuse_get_context.restype = ctypes.POINTER(fuse_context)
+        if hasattr(_libfuse, 'fuse_buf_copy'):
+            _libfuse.fuse_buf_size.argtypes = (ctypes.POINTER(fuse_bufvec),)
+            _libfuse.fuse_buf_size.restype = ctypes.c_size_t
+            _libfuse.fuse_buf_copy.argtypes = (ctypes.POINTER(fuse_bufvec),
+                                               ctypes.POINTER(fuse_bufvec),
+                                               ctypes.c_int)
+            _libfuse.fuse_buf_copy.restype = ctypes.c_ssize_t
+    return _libfuse
+
+_libc = None
+
+def _malloc(size):
+    '''
+    Allocates memory that libfuse releases with free(), or raises
+    FuseOSError(ENOMEM)
+    '''
+
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(None)
+        libc.malloc.argtypes = (ctypes.c_size_t,)
+        libc.malloc.restype = ctypes.c_void_p
+        libc.free.argtypes = (ctypes.c_void_p,)
+        libc.free.restype = None
+        _libc = libc
+
+    ptr = _libc.malloc(size)
+    if not ptr:
+        raise FuseOSError(errno.ENOMEM)
+    return ptr
+
+if _system == 'Darwin':
+    # The layout of c_stat depends on the flavour of libfuse installed, so it
+    # has to be loaded up front
+    _libfuse = _open_libfuse()
+    if hasattr(_libfuse, 'macfuse_version'):
+        _system = 'Darwin-MacFuse'
 
 
 if _system in ('Darwin', 'Darwin-MacFuse', 'FreeBSD'):
@@ -427,6 +529,9 @@ else:
             ('fh', ctypes.c_uint64),
             ('lock_owner', ctypes.c_uint64)]
 
+_fi_nonseekable = any(field[0] == 'nonseekable'
+                      for field in fuse_file_info._fields_)
+
 class fuse_context(ctypes.Structure):
     _fields_ = [
         ('fuse', ctypes.c_voidp),
@@ -435,8 +540,57 @@ class fuse_context(ctypes.Structure):
         ('pid', c_pid_t),
         ('private_data', ctypes.c_voidp)]
 
-_libfuse.fuse_get_context.restype = ctypes.POINTER(fuse_context)
+class fuse_conn_info(ctypes.Structure):
+    _fields_ = [
+        ('proto_major', ctypes.c_uint),
+        ('proto_minor', ctypes.c_uint),
+        ('async_read', ctypes.c_uint),
+        ('max_write', ctypes.c_uint),
+        ('max_readahead', ctypes.c_uint),
+        ('capable', ctypes.c_uint),
+        ('want', ctypes.c_uint),
+        ('max_background', ctypes.c_uint),
+        ('congestion_threshold', ctypes.c_uint),
+        ('reserved', ctypes.c_uint * 23)]
+
+# Capability bits of fuse_conn_info.capable and fuse_conn_info.want
+FUSE_CAP_ASYNC_READ = 1 << 0
+FUSE_CAP_POSIX_LOCKS = 1 << 1
+FUSE_CAP_ATOMIC_O_TRUNC = 1 << 3
+FUSE_CAP_EXPORT_SUPPORT = 1 << 4
+FUSE_CAP_BIG_WRITES = 1 << 5
+FUSE_CAP_DONT_MASK = 1 << 6
+FUSE_CAP_SPLICE_WRITE = 1 << 7
+FUSE_CAP_SPLICE_MOVE = 1 << 8
+FUSE_CAP_SPLICE_READ = 1 << 9
+FUSE_CAP_FLOCK_LOCKS = 1 << 10
+FUSE_CAP_IOCTL_DIR = 1 << 11
+
+# Flags of fuse_buf.flags
+FUSE_BUF_IS_FD = 1 << 1
+FUSE_BUF_FD_SEEK = 1 << 2
+FUSE_BUF_FD_RETRY = 1 << 3
+
+# Flags of fuse_buf_copy
+FUSE_BUF_NO_SPLICE = 1 << 1
+FUSE_BUF_FORCE_SPLICE = 1 << 2
+FUSE_BUF_SPLICE_MOVE = 1 << 3
+FUSE_BUF_SPLICE_NONBLOCK = 1 << 4
+
+class fuse_buf(ctypes.Structure):
+    _fields_ = [
+        ('size', ctypes.c_size_t),
+        ('flags', ctypes.c_int),
+        ('mem', ctypes.c_void_p),
+        ('fd', ctypes.c_int),
+        ('pos', c_off_t)]
 
+class fuse_bufvec(ctypes.Structure):
+    _fields_ = [
+        ('count', ctypes.c_size_t),
+        ('idx', ctypes.c_size_t),
+        ('off', ctypes.c_size_t),
+        ('buf', fuse_buf * 1)]
 
 class fuse_operations(ctypes.Structure):
     _fields_ = [
@@ -528,7 +682,9 @@ class fuse_operations(ctypes.Structure):
             ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
             ctypes.POINTER(fuse_file_info))),
 
-        ('init', ctypes.CFUNCTYPE(ctypes.c_voidp, ctypes.c_voidp)),
+        ('init', ctypes.CFUNCTYPE(
+            ctypes.c_voidp, ctypes.POINTER(fuse_conn_info))),
+
         ('destroy', ctypes.CFUNCTYPE(ctypes.c_voidp, ctypes.c_voidp)),
 
         ('access', ctypes.CFUNCTYPE(
@@ -565,6 +721,25 @@ class fuse_operations(ctypes.Structure):
         ('ioctl', ctypes.CFUNCTYPE(
             ctypes.c_int, ctypes.c_char_p, ctypes.c_uint, ctypes.c_void_p,
             ctypes.POINTER(fuse_file_info), ctypes.c_uint, ctypes.c_void_p)),
+
+        ('poll', ctypes.c_voidp),   # Not supported
+
+        ('write_buf', ctypes.CFUNCTYPE(
+            ctypes.c_int, ctypes.c_char_p, ctypes.POINTER(fuse_bufvec),
+            c_off_t, ctypes.POINTER(fuse_file_info))),
+
+        ('read_buf', ctypes.CFUNCTYPE(
+            ctypes.c_int, ctypes.c_char_p,
+            ctypes.POINTER(ctypes.POINTER(fuse_bufvec)), ctypes.c_size_t,
+            c_off_t, ctypes.POINTER(fuse_file_info))),
+
+        ('flock', ctypes.CFUNCTYPE(
+            ctypes.c_int, ctypes.c_char_p, ctypes.POINTER(fuse_file_info),
+            ctypes.c_int)),
+
+        ('fallocate', ctypes.CFUNCTYPE(
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_int, c_off_t, c_off_t,
+            ctypes.POINTER(fuse_file_info))),
     ]
 
 
@@ -574,26 +749,145 @@ def time_of_timespec(ts, use_ns=False):
     else:
         return ts.tv_sec + ts.tv_nsec / 1E9
 
+# Order of the fields of a tuple returned by getattr (the same as the
+# sequence order of os.stat_result)
+STAT_FIELDS = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid', 'st_gid',
+               'st_size', 'st_atime', 'st_mtime', 'st_ctime')
+
+_STAT_VALUES = STAT_FIELDS[:7] + (
+    'st_atime_sec', 'st_atime_nsec', 'st_mtime_sec', 'st_mtime_nsec',
+    'st_ctime_sec', 'st_ctime_nsec', 'st_rdev', 'st_blksize', 'st_blocks')
+
+def _compile_stat_packer():
+    '''
+    Returns a (struct, itemgetter) pair packing the values named in
+    _STAT_VALUES straight into a c_stat, or None if the layout of c_stat
+    cannot be described by a struct format.
+    '''
+
+    types = dict(c_stat._fields_)
+    timespec_types = dict(c_timespec._fields_)
+    fields = []
+    for index, name in enumerate(_STAT_VALUES):
+        if name.endswith('sec'):
+            name, part = name.rsplit('_', 1)
+            spec = name + 'spec'
+            if spec not in types:
+                continue
+            offset = (getattr(c_stat, spec).offset +
+                      getattr(c_timespec, 'tv_' + part).offset)
+            ctype = timespec_types['tv_' + part]
+        elif name in types:
+            offset = getattr(c_stat, name).offset
+            ctype = types[name]
+        else:
+            continue
+        fields.append((offset, ctype._type_, index))
+
+    fmt = '@'
+    for offset, code, index in sorted(fields):
+        padding = offset - struct.calcsize(fmt)
+        if padding < 0:
+            return None
+        fmt += '%dx%s' % (padding, code) if padding else code
+        if struct.calcsize(fmt) != offset + struct.calcsize('@' + code):
+            return None
+
+    return (struct.Struct(fmt),
+            itemgetter(*[index for offset, code, index in sorted(fields)]))
+
+_stat_packer = _compile_stat_packer()
+
+# Number of log2 latency buckets kept by FUSE.stats, the last one holding
+# everything from 2 ** (STATS_BUCKETS - 2) microseconds (about 17 minutes) on
+STATS_BUCKETS = 32
+
+# Seconds the result of an xattr size query is kept for the following fetch
+XATTR_PROBE_TIMEOUT = 1.0
+
+# Most xattr size query results kept at once
+XATTR_PROBE_SIZE = 1024
+
+def _split_time(val, use_ns):
+    if use_ns:
+        return divmod(int(val), 10 ** 9)
+
+    sec = int(val)
+    return sec, int((val - sec) * 1E9)
+
+def _pack_stat(st, attrs, use_ns):
+    if isinstance(attrs, os.stat_result):
+        times = (attrs.st_atime_ns, attrs.st_mtime_ns, attrs.st_ctime_ns)
+        use_ns = None not in times  # None unless made by os.stat
+        if not use_ns:
+            times = tuple(attrs[7:10])
+        extra = tuple(getattr(attrs, key, None) or 0
+                      for key in ('st_rdev', 'st_blksize', 'st_blocks'))
+    else:
+        times = tuple(attrs[7:10])
+        extra = (0, 0, 0)
+
+    values = tuple(attrs[:7])
+    if _stat_packer is not None:
+        packed = values
+        for val in times:
+            packed += _split_time(val, use_ns)
+
+        packer, getter = _stat_packer
+        try:
+            return packer.pack_into(st, 0, *getter(packed + extra))
+        except struct.error:
+            pass    # out of range, e.g. -1 for st_uid, which ctypes wraps
+
+    attrs = dict(zip(STAT_FIELDS + _STAT_VALUES[-3:], values + times + extra))
+    set_st_attrs(st, attrs, use_ns=use_ns)
+
 def set_st_attrs(st, attrs, use_ns=False):
+    '''
+    Fills the c_stat st from attrs, which is either a dict with keys identical
+    to the stat C structure, an os.stat_result, a c_stat or a tuple of the
+    values named in STAT_FIELDS.
+    '''
+
+    if isinstance(attrs, tuple):
+        return _pack_stat(st, attrs, use_ns)
+
+    if isinstance(attrs, c_stat):
+        ctypes.memmove(ctypes.addressof(st), ctypes.addressof(attrs),
+                       ctypes.sizeof(c_stat))
+        return
+
     for key, val in attrs.items():
         if key in ('st_atime', 'st_mtime', 'st_ctime', 'st_birthtime'):
             timespec = getattr(st, key + 'spec', None)
             if timespec is None:
                 continue
 
-            if use_ns:
-                timespec.tv_sec, timespec.tv_nsec = divmod(int(val), 10 ** 9)
-            else:
-                timespec.tv_sec = int(val)
-                timespec.tv_nsec = int((val - timespec.tv_sec) * 1E9)
+            timespec.tv_sec, timespec.tv_nsec = _split_time(val, use_ns)
         elif hasattr(st, key):
             setattr(st, key, val)
 
 
+def buffer_view(buf, size, readonly=False):
+    '''
+    Returns a memoryview over size bytes at the ctypes pointer buf.
+
+    memoryview.toreadonly needs Python 3.8; before that a readonly view is
+    taken of a copy of the bytes.
+    '''
+
+    if readonly and not hasattr(memoryview, 'toreadonly'):
+        return memoryview(ctypes.string_at(buf, size))
+
+    array = ctypes.cast(buf, ctypes.POINTER(ctypes.c_ubyte * size)).contents
+    view = memoryview(array).cast('B')
+    return view.toreadonly() if readonly else view
+
+
 def fuse_get_context():
     'Returns a (uid, gid, pid) tuple'
 
-    ctxp = _libfuse.fuse_get_context()
+    ctxp = _load_libfuse().fuse_get_context()
     ctx = ctxp.contents
     return ctx.uid, ctx.gid, ctx.pid
 
@@ -606,8 +900,11 @@ def fuse_exit():
     Flags the native FUSE session as terminated and will cause any running FUSE
     event loops to exit on the next opportunity. (see fuse.c::fuse_exit)
     '''
-    fuse_ptr = ctypes.c_void_p(_libfuse.fuse_get_context().contents.fuse)
-    _libfuse.fuse_exit(fuse_ptr)
+    libfuse = _load_libfuse()
+    ctxp = libfuse.fuse_get_context()
+    if not ctxp:
+        return  # not called from a FUSE operation, nothing is running
+    libfuse.fuse_exit(ctypes.c_void_p(ctxp.contents.fuse))
 
 
 class FuseOSError(OSError):
@@ -615,6 +912,392 @@ class FuseOSError(OSError):
         super(FuseOSError, self).__init__(errno, os.strerror(errno))
 
 
+class FuseErrno(int):
+    '''
+    A negative errno value an operation may return instead of raising
+    FuseOSError, e.g. return FuseErrno.ENOENT. It reaches libfuse without an
+    exception being raised, caught or logged, which matters for expected
+    failures such as the lookups of missing files that shells and compilers
+    make all the time. Raise FuseOSError for unexpected errors.
+    '''
+
+    __slots__ = ()
+
+    def __new__(cls, err):
+        return super(FuseErrno, cls).__new__(cls, -abs(err))
+
+    @property
+    def errno(self):
+        return -self
+
+    def __repr__(self):
+        return 'FuseErrno.%s' % errno.errorcode.get(-self, -self)
+
+for _name in dir(errno):
+    if _name.startswith('E') and isinstance(getattr(errno, _name), int):
+        setattr(FuseErrno, _name, FuseErrno(getattr(errno, _name)))
+del _name
+
+
+class _OperationTable(dict):
+    '''
+    Maps operation names to the callables FUSE dispatches to.
+
+    Each name is resolved once. Operations that do not override __call__ are
+    dispatched straight to their bound methods, anything else goes through
+    operations(name, *args).
+    '''
+
+    def __init__(self, operations, tracer=None, single_flight=None):
+        super(_OperationTable, self).__init__()
+        self.operations = operations
+        self.tracer = tracer
+        self.single_flight = single_flight
+        self.direct = (isinstance(operations, Operations) and
+                       type(operations).__call__ in (Operations.__call__,
+                                                     AsyncOperations.__call__))
+
+    def __missing__(self, op):
+        if not self.direct:
+            func = partial(self.operations, op)
+        else:
+            func = getattr(self.operations, op, None)
+            if func is None:
+                raise FuseOSError(errno.EFAULT)
+
+        # Plain methods may return coroutines too, e.g. those of mix-ins
+        if isinstance(self.operations, AsyncOperations):
+            func = self.operations.blocking(func)
+
+        if self.single_flight is not None:
+            func = self.single_flight.wrap(op, func)
+
+        if self.tracer is not None:
+            func = self.tracer.wrap(op, func)
+
+        self[op] = func
+        return func
+
+
+class OpenResult(object):
+    '''
+    May be returned by open and create instead of a plain file handle to set
+    the caching flags of the opened file.
+
+    direct_io bypasses the page cache for the file, keep_cache keeps the
+    cached data of the file when it is opened again and nonseekable marks
+    the file as not seekable (ignored where unsupported).
+    '''
+
+    __slots__ = ('fh', 'direct_io', 'keep_cache', 'nonseekable')
+
+    def __init__(self, fh=0, direct_io=False, keep_cache=False,
+                 nonseekable=False):
+        self.fh = fh
+        self.direct_io = direct_io
+        self.keep_cache = keep_cache
+        self.nonseekable = nonseekable
+
+    def __repr__(self):
+        return 'OpenResult(fh=%r, direct_io=%r, keep_cache=%r, ' \
+               'nonseekable=%r)' % (self.fh, self.direct_io, self.keep_cache,
+                                    self.nonseekable)
+
+
+class FileRegion(object):
+    '''
+    May be returned by read instead of the data to have libfuse read length
+    bytes at offset from the file descriptor fd itself.
+
+    If the operations class sets use_read_buf, libfuse can then splice the
+    data from fd to the kernel without copying it through Python. Otherwise
+    FUSE reads the region with os.pread. fd must stay open until the read
+    completes.
+    '''
+
+    __slots__ = ('fd', 'offset', 'length')
+
+    def __init__(self, fd, offset, length):
+        self.fd = fd
+        self.offset = offset
+        self.length = length
+
+    def __repr__(self):
+        return 'FileRegion(fd=%r, offset=%r, length=%r)' % (
+            self.fd, self.offset, self.length)
+
+
+class _Call(object):
+    'An operation call in flight, see _SingleFlight'
+
+    __slots__ = ('result', 'error', 'event')
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.event = None   # only created once a second caller waits
+
+
+class _SingleFlight(object):
+    '''
+    Lets concurrent calls of an operation with the same key share a single
+    call, whose result (or exception) every caller receives.
+    '''
+
+    # Keys of the idempotent operations that are coalesced, computed from
+    # their arguments. The file handle of getattr and read is ignored (unless
+    # there is no path), so that the same read of a file opened by several
+    # processes is only made once.
+    KEYS = {
+        'getattr': lambda path, fh=None: (
+            (path,) if path is not None else (path, fh)),
+        'read': lambda path, size, offset, fh: (
+            (path, size, offset) if path is not None else
+            (path, size, offset, fh)),
+        'readlink': lambda path: (path,),
+        'getxattr': lambda path, name, *args: (path, name) + args,
+        'listxattr': lambda path: (path,),
+        'statfs': lambda path: (path,),
+    }
+
+    # Operations that modify the filesystem. When one returns, the calls in
+    # flight are closed to newcomers, which could otherwise get a result from
+    # before the modification.
+    MODIFYING = frozenset((
+        'chmod', 'chown', 'create', 'fallocate', 'link', 'mkdir', 'mknod',
+        'removexattr', 'rename', 'rmdir', 'setxattr', 'symlink', 'truncate',
+        'unlink', 'utimens', 'write', 'write_buf'))
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+
+    def wrap(self, op, func):
+        lock = self.lock
+        calls = self.calls
+
+        if op in self.MODIFYING:
+            def modifying(*args):
+                try:
+                    return func(*args)
+                finally:
+                    if calls:
+                        with lock:
+                            calls.clear()
+
+            return modifying
+
+        key_of = self.KEYS.get(op)
+        if key_of is None:
+            return func
+
+        def coalesced(*args):
+            try:
+                key = (op,) + key_of(*args)
+                hash(key)
+            except TypeError:
+                return func(*args)
+
+            with lock:
+                call = calls.get(key)
+                if call is None:
+                    call = calls[key] = _Call()
+                    leader = True
+                else:
+                    leader = False
+                    if call.event is None:
+                        call.event = Event()
+
+            if not leader:
+                call.event.wait()
+                if call.error is not None:
+                    raise call.error
+                return call.result
+
+            try:
+                call.result = func(*args)
+                return call.result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with lock:
+                    if calls.get(key) is call:
+                        del calls[key]
+                    event = call.event
+                if event is not None:
+                    event.set()
+
+        return coalesced
+
+
+class _DirCursor(object):
+    'Position of a streaming readdir on an open directory handle'
+
+    __slots__ = ('fh', 'entries', 'offset', 'pending')
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.entries = None
+        self.offset = 0
+        self.pending = None
+
+# Record layout of the trace files written by FUSE(..., trace=path): the
+# operation (index into the op names in the file header), thread, start time
+# in seconds since the trace started, duration in seconds, result (a negative
+# errno, the number of bytes or entries returned or the handle opened), file
+# handle, two operation specific integers (e.g. size and offset of a read)
+# and the lengths of the path and of a second path (or xattr name) that
+# follow the record.
+_TRACE_MAGIC = b'FUSETRC1'
+_trace_record = struct.Struct('<BQdfqQqqHH')
+_U64_MASK = (1 << 64) - 1
+
+# Operation arguments (after the path) stored in the a, b, fh and path2
+# fields of a trace record
+_TRACE_ARGS = {
+    'access': ('a',),
+    'chmod': ('a',),
+    'chown': ('a', 'b'),
+    'create': ('a',),
+    'fgetattr': ('fh',),
+    'flush': ('fh',),
+    'fsync': ('a', 'fh'),
+    'fsyncdir': ('a', 'fh'),
+    'getattr': ('fh',),
+    'getxattr': ('path2', 'b'),
+    'link': ('path2',),
+    'mkdir': ('a',),
+    'mknod': ('a', 'b'),
+    'open': ('a',),
+    'read': ('a', 'b', 'fh'),
+    'read_into': ('a', 'b', 'fh'),
+    'readdir': ('fh',),
+    'release': ('fh',),
+    'releasedir': ('fh',),
+    'removexattr': ('path2',),
+    'rename': ('path2',),
+    'setxattr': ('path2', 'a', 'b'),
+    'symlink': ('path2',),
+    'truncate': ('a', 'fh'),
+    'write': ('a', 'b', 'fh'),
+}
+
+TraceRecord = namedtuple('TraceRecord', 'op thread start duration result fh '
+                                        'a b path path2')
+
+
+class _Tracer(object):
+    'Records the operations dispatched by FUSE to a trace file'
+
+    def __init__(self, path, encoding):
+        self.file = open(path, 'wb')
+        self.encoding = encoding
+        self.names = sorted(name for name, prototype in
+                            (ent[:2] for ent in fuse_operations._fields_)
+                            if hasattr(prototype, 'argtypes'))
+        self.names.extend(name for name in _TRACE_ARGS
+                          if name not in self.names)
+        self.lock = Lock()
+        self.start = _monotonic()
+
+        names = '\x00'.join(self.names).encode('ascii')
+        self.file.write(_TRACE_MAGIC + struct.pack('<H', len(names)) + names)
+
+    def _encode(self, path):
+        if path is None:
+            return b''
+        if not isinstance(path, bytes):
+            path = path.encode(self.encoding)
+        return path
+
+    def wrap(self, op, func):
+        if op not in self.names:
+            return func
+
+        code = self.names.index(op)
+        slots = tuple(enumerate(_TRACE_ARGS.get(op, ())))
+        pack = _trace_record.pack
+        encode = self._encode
+        write = self.file.write
+        lock = self.lock
+        trace_start = self.start
+
+        def traced(path=None, *args):
+            start = _monotonic()
+            result = 0
+            try:
+                ret = func(path, *args)
+                if isinstance(ret, OpenResult):
+                    result = ret.fh
+                elif isinstance(ret, (int, long)):
+                    result = ret
+                elif hasattr(ret, '__len__'):
+                    result = len(ret)
+                return ret
+            except OSError as e:
+                result = -(e.errno or errno.EINVAL)
+                raise
+            except BaseException:
+                result = -errno.EINVAL
+                raise
+            finally:
+                duration = _monotonic() - start
+
+                fields = {'fh': 0, 'a': 0, 'b': 0, 'path2': None}
+                for i, field in slots:
+                    if i >= len(args):
+                        break
+                    arg = args[i]
+                    if field == 'path2' or isinstance(arg, (int, long)):
+                        fields[field] = arg
+                    elif isinstance(arg, (bytes, memoryview)):
+                        fields[field] = len(arg)
+                    elif field == 'fh':
+                        fields[field] = getattr(arg, 'fh', 0)
+
+                path_ = encode(path)
+                path2 = encode(fields['path2'])
+                record = pack(code, get_ident(), start - trace_start,
+                              duration, result, fields['fh'] & _U64_MASK,
+                              fields['a'], fields['b'], len(path_),
+                              len(path2)) + path_ + path2
+                with lock:
+                    write(record)
+
+        return traced
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_trace(path):
+    '''
+    Yields the TraceRecords of a trace file written by FUSE(..., trace=path).
+    path and path2 are bytes, or None if not recorded.
+    '''
+
+    with open(path, 'rb') as f:
+        if f.read(len(_TRACE_MAGIC)) != _TRACE_MAGIC:
+            raise ValueError('%s is not a FUSE trace file' % path)
+        size, = struct.unpack('<H', f.read(2))
+        names = f.read(size).decode('ascii').split('\x00')
+
+        record_size = _trace_record.size
+        unpack = _trace_record.unpack
+        while True:
+            record = f.read(record_size)
+            if len(record) < record_size:
+                return
+            (op, thread, start, duration, result, fh, a, b, path_size,
+             path2_size) = unpack(record)
+            path = f.read(path_size) or None
+            path2 = f.read(path2_size) or None
+            yield TraceRecord(names[op], thread, start, duration, result, fh,
+                              a, b, path, path2)
+
+
 class FUSE(object):
     '''
     This class is the lower level interface and should not be subclassed under
@@ -630,20 +1313,163 @@ class FUSE(object):
     )
 
     def __init__(self, operations, mountpoint, raw_fi=False, encoding='utf-8',
-                 **kwargs):
+                 bytes_paths=False, path_cache_size=0, stream_readdir=False,
+                 trace=None, stats_file=None, stats_interval=10,
+                 negative_cache_timeout=0, negative_cache_size=10000,
+                 coalesce=False, max_workers=0, **kwargs):
 
         '''
         Setting raw_fi to True will cause FUSE to pass the fuse_file_info
         class as is to Operations, instead of just the fh field.
 
         This gives you access to direct_io, keep_cache, etc.
+
+        Setting bytes_paths to True will cause FUSE to pass paths (and xattr
+        names) to Operations as the raw bytes received from the kernel,
+        without decoding them. readdir, readlink and listxattr may then return
+        bytes as well.
+
+        Setting path_cache_size keeps that many decoded paths in an LRU cache
+        instead of decoding every path on every call.
+
+        Setting stream_readdir to True keeps a cursor over the result of
+        readdir for every handle returned by opendir (until releasedir), so
+        that a listing which does not fit in the kernel buffer is resumed
+        where it stopped instead of calling readdir again and skipping the
+        entries already returned. Entries are numbered by FUSE, any offsets
+        returned by readdir are ignored. Requires opendir and releasedir.
+
+        Setting trace to a file name records every operation dispatched to
+        Operations (name, path, sizes, file handle, thread, start time,
+        duration and result) to that file in a compact binary format, see
+        read_trace. fusebench.py can replay it.
+
+        Call counts, errors, bytes transferred and latency histograms of all
+        operations are always kept, see stats. Setting stats_file writes them
+        to that file in the Prometheus text format every stats_interval
+        seconds.
+
+        Setting negative_cache_timeout remembers for that many seconds (up
+        to negative_cache_size paths) that getattr failed with ENOENT, and
+        answers the next lookups of those paths without calling getattr.
+        Paths created through this mount are forgotten right away, but
+        files that appear on the backend in the meantime stay hidden until
+        the timeout expires.
+
+        Setting coalesce to True makes concurrent identical calls of getattr,
+        read, readlink, getxattr, listxattr and statfs share a single call,
+        whose result all of them receive. getattr and read calls on
+        different file handles of the same path count as identical. Calls
+        made after a modifying operation (write, truncate, chmod...) through
+        this mount returned do not join calls started before it.
+
+        Setting max_workers to N lets at most N operations run at once; the
+        threads libfuse starts for further requests wait for one of them to
+        finish. libfuse 2.x starts a new thread whenever all of its threads
+        are busy, so without it a slow backend may be hit by as many
+        concurrent calls as there are requests in flight.
         '''
 
+        self._setup(operations, raw_fi, encoding, bytes_paths, path_cache_size,
+                    stream_readdir, trace, stats_file, stats_interval,
+                    negative_cache_timeout, negative_cache_size, coalesce,
+                    max_workers)
+
+        args = ['fuse']
+
+        args.extend(flag for arg, flag in self.OPTIONS
+                    if kwargs.pop(arg, False))
+
+        kwargs.setdefault('fsname', operations.__class__.__name__)
+        args.append('-o')
+        args.append(','.join(self._normalize_fuse_options(**kwargs)))
+        args.append(mountpoint)
+
+        args = [arg.encode(encoding) for arg in args]
+        argv = (ctypes.c_char_p * len(args))(*args)
+
+        libfuse = _load_libfuse()
+        fuse_ops = self._fuse_operations(hasattr(libfuse, 'fuse_buf_copy'))
+
+        if isinstance(operations, Operations):
+            operations.fuse_instance = self
+
+        try:
+            old_handler = signal(SIGINT, SIG_DFL)
+        except ValueError:
+            old_handler = SIG_DFL
+
+        err = libfuse.fuse_main_real(
+            len(args), argv, ctypes.pointer(fuse_ops),
+            ctypes.sizeof(fuse_ops),
+            None)
+
+        try:
+            signal(SIGINT, old_handler)
+        except ValueError:
+            pass
+
+        if isinstance(operations, AsyncOperations):
+            operations.stop_loop()
+        if isinstance(operations, Operations):
+            operations.fuse_instance = None
+        self._fuse = None
+        if self._tracer is not None:
+            self._tracer.close()
+
+        del self._ops
+        del self.operations     # Invoke the destructor
+        if self.__critical_exception:
+            raise self.__critical_exception
+        if err:
+            raise RuntimeError(err)
+
+    def _setup(self, operations, raw_fi=False, encoding='utf-8',
+               bytes_paths=False, path_cache_size=0, stream_readdir=False,
+               trace=None, stats_file=None, stats_interval=10,
+               negative_cache_timeout=0, negative_cache_size=10000,
+               coalesce=False, max_workers=0):
+        'Prepares to serve operations with the options of __init__'
+
         self.operations = operations
+        self._workers = BoundedSemaphore(max_workers) if max_workers else None
+        self._tracer = _Tracer(trace, encoding) if trace else None
+        self._negative = None
+        if negative_cache_timeout:
+            self._negative_forgets = count(1)
+            self._negative_generation = 0
+            self._negative = _ExpiringCache(negative_cache_size,
+                                            negative_cache_timeout)
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self._stats_lock = Lock()
+        self._stats_threads = {}
+        self._stats_stop = None
+        self._stats_thread = None
+        self._ops = _OperationTable(operations, self._tracer,
+                                    _SingleFlight() if coalesce else None)
         self.raw_fi = raw_fi
         self.encoding = encoding
+        self.bytes_paths = bytes_paths
+        self.stream_readdir = stream_readdir
+        self._dir_cursors = {}
+        self._dir_handles = count(1)
+        self._xattr_probe = _ExpiringCache(XATTR_PROBE_SIZE,
+                                           XATTR_PROBE_TIMEOUT)
+        self._fuse = None
+        self.use_read_into = getattr(operations, 'read_into', None) is not None
+        self.write_memoryview = getattr(operations, 'write_memoryview', False)
         self.__critical_exception = None
 
+        if bytes_paths:
+            self._decode = lambda path: path
+        else:
+            self._decode = methodcaller('decode', encoding)
+            if path_cache_size and lru_cache is not None:
+                self._decode = lru_cache(path_cache_size)(self._decode)
+
+        self.use_conn_info = getattr(operations, 'use_conn_info', False)
+        self.utime_omit_ok = getattr(operations, 'flag_utime_omit_ok', False)
         self.use_ns = getattr(operations, 'use_ns', False)
         if not self.use_ns:
             warnings.warn(
@@ -653,19 +1479,13 @@ class FUSE(object):
                 'requirements to <4.',
                 DeprecationWarning)
 
-        args = ['fuse']
-
-        args.extend(flag for arg, flag in self.OPTIONS
-                    if kwargs.pop(arg, False))
-
-        kwargs.setdefault('fsname', operations.__class__.__name__)
-        args.append('-o')
-        args.append(','.join(self._normalize_fuse_options(**kwargs)))
-        args.append(mountpoint)
-
-        args = [arg.encode(encoding) for arg in args]
-        argv = (ctypes.c_char_p * len(args))(*args)
+    def _fuse_operations(self, has_buf=False):
+        '''
+        Returns the fuse_operations structure dispatching to this instance.
+        read_buf and write_buf are left out unless has_buf is set.
+        '''
 
+        operations = self.operations
         fuse_ops = fuse_operations()
         for ent in fuse_operations._fields_:
             name, prototype = ent[:2]
@@ -678,37 +1498,67 @@ class FUSE(object):
                 check_name = check_name[1:]
 
             val = getattr(operations, check_name, None)
+
+            # read_buf() is implemented in terms of read(), but only used if
+            # asked for and supported by libfuse (2.9 or later)
+            if check_name == 'read_buf':
+                val = getattr(operations, 'use_read_buf', False) or None
+            if check_name in ('read_buf', 'write_buf') and not has_buf:
+                val = None
+
             if val is None:
                 continue
 
             # Function pointer members are tested for using the
-            # getattr(operations, name) above but are dynamically
-            # invoked using self.operations(name)
+            # getattr(operations, name) above and dispatched through
+            # self._ops, which resolves each operation only once
             if hasattr(prototype, 'argtypes'):
-                val = prototype(partial(self._wrapper, getattr(self, name)))
+                val = prototype(self._wrapper(getattr(self, name)))
 
             setattr(fuse_ops, name, val)
 
-        try:
-            old_handler = signal(SIGINT, SIG_DFL)
-        except ValueError:
-            old_handler = SIG_DFL
+        return fuse_ops
 
-        err = _libfuse.fuse_main_real(
-            len(args), argv, ctypes.pointer(fuse_ops),
-            ctypes.sizeof(fuse_ops),
-            None)
+    @property
+    def can_invalidate(self):
+        '''
+        True if invalidate is supported, i.e. libfuse provides
+        fuse_invalidate_path. The libfuse 2.x of Linux and FreeBSD does not,
+        macFUSE does.
+        '''
 
-        try:
-            signal(SIGINT, old_handler)
-        except ValueError:
-            pass
+        return _libfuse is not None and \
+            hasattr(_libfuse, 'fuse_invalidate_path')
 
-        del self.operations     # Invoke the destructor
-        if self.__critical_exception:
-            raise self.__critical_exception
-        if err:
-            raise RuntimeError(err)
+    def invalidate(self, path):
+        '''
+        Drops the cached attributes, data and lookup of path from the kernel,
+        e.g. after it changed on the backend. May be called from any thread
+        while mounted.
+
+        Only available if can_invalidate is true, otherwise raises
+        FuseOSError(ENOSYS). Elsewhere use short attr_timeout and
+        entry_timeout mount options, or the low-level FUSELL, whose
+        invalidate_inode and invalidate_entry work with every libfuse 2.8+.
+        '''
+
+        if not self.can_invalidate:
+            raise FuseOSError(errno.ENOSYS)
+        if not self._fuse:
+            raise FuseOSError(errno.ENODEV)
+
+        if not isinstance(path, bytes):
+            path = path.encode(self.encoding)
+        err = _libfuse.fuse_invalidate_path(ctypes.c_void_p(self._fuse), path)
+        # nothing to do if the kernel does not know the path
+        if err < 0 and err != -errno.ENOENT:
+            raise FuseOSError(-err)
+
+    def invalidate_entry(self, parent, name):
+        'Drops the cached lookup of name in the directory parent'
+
+        return self.invalidate(posixpath.join(self._encode(parent),
+                                              self._encode(name)))
 
     @staticmethod
     def _normalize_fuse_options(**kargs):
@@ -719,63 +1569,221 @@ class FUSE(object):
             else:
                 yield '%s=%s' % (key, value)
 
-    @staticmethod
-    def _wrapper(func, *args, **kwargs):
-        'Decorator for the methods that follow'
+    def _wrapper(self, func):
+        'Wraps the methods that follow for use as ctypes callbacks'
 
-        try:
-            if func.__name__ == "init":
-                # init may not fail, as its return code is just stored as
-                # private_data field of struct fuse_context
-                return func(*args, **kwargs) or 0
+        name = func.__name__
 
-            else:
-                try:
-                    return func(*args, **kwargs) or 0
-
-                except OSError as e:
-                    if e.errno > 0:
-                        log.debug(
-                            "FUSE operation %s raised a %s, returning errno %s.",
-                            func.__name__, type(e), e.errno, exc_info=True)
-                        return -e.errno
-                    else:
-                        log.error(
-                            "FUSE operation %s raised an OSError with negative "
-                            "errno %s, returning errno.EINVAL.",
-                            func.__name__, e.errno, exc_info=True)
-                        return -errno.EINVAL
-
-                except Exception:
-                    log.error("Uncaught exception from FUSE operation %s, "
-                              "returning errno.EINVAL.",
-                              func.__name__, exc_info=True)
-                    return -errno.EINVAL
-
-        except BaseException as e:
+        def critical(e):
             self.__critical_exception = e
             log.critical(
                 "Uncaught critical exception from FUSE operation %s, aborting.",
-                func.__name__, exc_info=True)
+                name, exc_info=True)
             # the raised exception (even SystemExit) will be caught by FUSE
             # potentially causing SIGSEGV, so tell system to stop/interrupt FUSE
             fuse_exit()
             return -errno.EFAULT
 
+        if name == 'init':
+            # init may not fail, as its return code is just stored as
+            # private_data field of struct fuse_context
+            def wrapper(*args):
+                try:
+                    return func(*args) or 0
+                except BaseException as e:
+                    return critical(e)
+
+            return wrapper
+
+        # Counters are looked up by thread id: the callbacks of libfuse run on
+        # C threads, where ctypes makes a new Python thread state (and so an
+        # empty threading.local) for every call
+        threads = self._stats_threads
+        count_bytes = name in ('read', 'write', 'write_buf')
+        # read_buf returns 0, the size read is that of the buffer it made
+        count_buf = name == 'read_buf'
+        workers = self._workers
+
+        def wrapper(*args):
+            start = _monotonic()
+            if workers is not None:
+                workers.acquire()
+            try:
+                ret = func(*args) or 0
+
+            except OSError as e:
+                if e.errno > 0:
+                    log.debug(
+                        "FUSE operation %s raised a %s, returning errno %s.",
+                        name, type(e), e.errno, exc_info=True)
+                    ret = -e.errno
+                else:
+                    log.error(
+                        "FUSE operation %s raised an OSError with negative "
+                        "errno %s, returning errno.EINVAL.",
+                        name, e.errno, exc_info=True)
+                    ret = -errno.EINVAL
+
+            except Exception:
+                log.error("Uncaught exception from FUSE operation %s, "
+                          "returning errno.EINVAL.",
+                          name, exc_info=True)
+                ret = -errno.EINVAL
+
+            except BaseException as e:
+                return critical(e)
+
+            finally:
+                if workers is not None:
+                    workers.release()
+
+            elapsed = _monotonic() - start
+            try:
+                counters = threads[get_ident()][name]
+            except KeyError:
+                counters = self._thread_counters(name)
+
+            counters[0] += 1
+            counters[1] += elapsed
+            counters[2][min(int(elapsed * 1e6).bit_length(),
+                            STATS_BUCKETS - 1)] += 1
+            if ret < 0:
+                errors = counters[3]
+                errors[-ret] = errors.get(-ret, 0) + 1
+            elif count_bytes:
+                counters[4] += ret
+            elif count_buf:
+                counters[4] += args[1][0].contents.buf[0].size
+
+            return ret
+
+        return wrapper
+
+    def _thread_counters(self, name):
+        '''
+        Returns the counters of operation name for the calling thread: the
+        number of calls, their total duration, the latency histogram, the
+        number of failures per errno and the number of bytes transferred.
+        '''
+
+        # A new thread may reuse the counters of an exited one
+        with self._stats_lock:
+            ops = self._stats_threads.setdefault(get_ident(), {})
+            counters = ops.get(name)
+            if counters is None:
+                counters = ops[name] = [0, 0.0, [0] * STATS_BUCKETS, {}, 0]
+        return counters
+
+    def stats(self):
+        '''
+        Returns the statistics of the operations called so far, as a dict
+        mapping operation names to dicts with:
+
+          calls    number of calls
+          seconds  total time spent in them
+          latency  list of STATS_BUCKETS counts, bucket i counting the calls
+                   that took less than 2 ** i microseconds (and not less
+                   than 2 ** (i - 1))
+          errors   dict mapping errno values to the number of calls that
+                   failed with them
+          bytes    bytes read or written (read, read_buf, write and write_buf
+                   only)
+        '''
+
+        with self._stats_lock:
+            threads = [list(ops.items())
+                       for ops in self._stats_threads.values()]
+
+        stats = {}
+        for ops in threads:
+            for name, (calls, seconds, latency, errors, nbytes) in ops:
+                op = stats.get(name)
+                if op is None:
+                    op = stats[name] = dict(calls=0, seconds=0.0,
+                                            latency=[0] * STATS_BUCKETS,
+                                            errors={}, bytes=0)
+                op['calls'] += calls
+                op['seconds'] += seconds
+                op['latency'] = [a + b for a, b in zip(op['latency'], latency)]
+                for err, count in list(errors.items()):
+                    op['errors'][err] = op['errors'].get(err, 0) + count
+                op['bytes'] += nbytes
+        return stats
+
+    def _write_stats(self):
+        'Writes stats() to stats_file in the Prometheus text format'
+
+        lines = []
+        add = lines.append
+        stats = sorted(self.stats().items())
+
+        add('# TYPE fuse_operations_total counter')
+        for name, op in stats:
+            add('fuse_operations_total{op="%s"} %d' % (name, op['calls']))
+
+        add('# TYPE fuse_operation_errors_total counter')
+        for name, op in stats:
+            for err, count in sorted(op['errors'].items()):
+                add('fuse_operation_errors_total{op="%s",errno="%s"} %d' % (
+                    name, errno.errorcode.get(err, err), count))
+
+        add('# TYPE fuse_operation_bytes_total counter')
+        for name, op in stats:
+            if op['bytes']:
+                add('fuse_operation_bytes_total{op="%s"} %d' % (
+                    name, op['bytes']))
+
+        add('# TYPE fuse_operation_duration_seconds histogram')
+        for name, op in stats:
+            total = 0
+            for i, count in enumerate(op['latency'][:-1]):
+                total += count
+                add('fuse_operation_duration_seconds_bucket'
+                    '{op="%s",le="%g"} %d' % (name, 2 ** i / 1e6, total))
+            add('fuse_operation_duration_seconds_bucket{op="%s",le="+Inf"} %d'
+                % (name, op['calls']))
+            add('fuse_operation_duration_seconds_sum{op="%s"} %f' % (
+                name, op['seconds']))
+            add('fuse_operation_duration_seconds_count{op="%s"} %d' % (
+                name, op['calls']))
+
+        tmp = '%s.tmp' % self.stats_file
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp, self.stats_file)
+
+    def _stats_writer(self, stop):
+        while True:
+            stopped = stop.wait(self.stats_interval)
+            try:
+                self._write_stats()
+            except Exception:
+                log.error('Unable to write FUSE statistics to %s',
+                          self.stats_file, exc_info=True)
+            if stopped:
+                return
+
     def _decode_optional_path(self, path):
         # NB: this method is intended for fuse operations that
         #     allow the path argument to be NULL,
         #     *not* as a generic path decoding method
         if path is None:
             return None
-        return path.decode(self.encoding)
+        return self._decode(path)
+
+    def _encode(self, name):
+        if isinstance(name, bytes):
+            return name
+        return name.encode(self.encoding)
 
     def getattr(self, path, buf):
         return self.fgetattr(path, buf, None)
 
     def readlink(self, path, buf, bufsize):
-        ret = self.operations('readlink', path.decode(self.encoding)) \
-                  .encode(self.encoding)
+        ret = self._ops['readlink'](self._decode(path))
+        if type(ret) is FuseErrno:
+            return ret
+        ret = self._encode(ret)
 
         # copies a string into the given buffer
         # (null terminated and truncated if necessary)
@@ -784,35 +1792,74 @@ class FUSE(object):
         return 0
 
     def mknod(self, path, mode, dev):
-        return self.operations('mknod', path.decode(self.encoding), mode, dev)
+        try:
+            return self._ops['mknod'](self._decode(path), mode, dev)
+        finally:
+            self._forget_missing(path)
 
     def mkdir(self, path, mode):
-        return self.operations('mkdir', path.decode(self.encoding), mode)
+        try:
+            return self._ops['mkdir'](self._decode(path), mode)
+        finally:
+            self._forget_missing(path)
 
     def unlink(self, path):
-        return self.operations('unlink', path.decode(self.encoding))
+        return self._ops['unlink'](self._decode(path))
 
     def rmdir(self, path):
-        return self.operations('rmdir', path.decode(self.encoding))
+        return self._ops['rmdir'](self._decode(path))
 
     def symlink(self, source, target):
         'creates a symlink `target -> source` (e.g. ln -s source target)'
 
-        return self.operations('symlink', target.decode(self.encoding),
-                                          source.decode(self.encoding))
+        try:
+            return self._ops['symlink'](self._decode(target),
+                                        self._decode(source))
+        finally:
+            self._forget_missing(target, tree=True)
 
     def rename(self, old, new):
-        return self.operations('rename', old.decode(self.encoding),
-                                         new.decode(self.encoding))
+        try:
+            return self._ops['rename'](self._decode(old), self._decode(new))
+        finally:
+            self._forget_missing(new, tree=True)
 
     def link(self, source, target):
         'creates a hard link `target -> source` (e.g. ln source target)'
 
-        return self.operations('link', target.decode(self.encoding),
-                                       source.decode(self.encoding))
+        try:
+            return self._ops['link'](self._decode(target),
+                                     self._decode(source))
+        finally:
+            self._forget_missing(target)
+
+    def _remember_missing(self, path, generation):
+        '''
+        Adds path to the negative cache unless a path was forgotten since
+        generation was read, the path may then have been created meanwhile
+        '''
+
+        if generation == self._negative_generation:
+            self._negative.set(path, True)
+            # Checked again in case _forget_missing ran in between
+            if generation != self._negative_generation:
+                self._negative.discard(path)
+
+    def _forget_missing(self, path, tree=False):
+        'Drops path and its parent (or its whole tree) from the negative cache'
+
+        negative = self._negative
+        if negative is None:
+            return
+        self._negative_generation = next(self._negative_forgets)
+        negative.discard(posixpath.dirname(path))
+        if tree:
+            negative.discard_tree(path)
+        else:
+            negative.discard(path)
 
     def chmod(self, path, mode):
-        return self.operations('chmod', path.decode(self.encoding), mode)
+        return self._ops['chmod'](self._decode(path), mode)
 
     def chown(self, path, uid, gid):
         # Check if any of the arguments is a -1 that has overflowed
@@ -821,29 +1868,51 @@ class FUSE(object):
         if c_gid_t(gid + 1).value == 0:
             gid = -1
 
-        return self.operations('chown', path.decode(self.encoding), uid, gid)
+        return self._ops['chown'](self._decode(path), uid, gid)
 
     def truncate(self, path, length):
-        return self.operations('truncate', path.decode(self.encoding), length)
+        return self._ops['truncate'](self._decode(path), length)
 
     def open(self, path, fip):
         fi = fip.contents
         if self.raw_fi:
-            return self.operations('open', path.decode(self.encoding), fi)
+            return self._ops['open'](self._decode(path), fi)
         else:
-            fi.fh = self.operations('open', path.decode(self.encoding),
-                                            fi.flags)
+            ret = self._ops['open'](self._decode(path), fi.flags)
+            if type(ret) is FuseErrno:
+                return ret
+            self._set_fh(fi, ret)
 
             return 0
 
+    @staticmethod
+    def _set_fh(fi, ret):
+        if not isinstance(ret, OpenResult):
+            fi.fh = ret
+            return
+
+        fi.fh = ret.fh
+        fi.direct_io = ret.direct_io
+        fi.keep_cache = ret.keep_cache
+        if _fi_nonseekable:
+            fi.nonseekable = ret.nonseekable
+
     def read(self, path, buf, size, offset, fip):
         if self.raw_fi:
           fh = fip.contents
         else:
           fh = fip.contents.fh
 
-        ret = self.operations('read', self._decode_optional_path(path), size,
-                                      offset, fh)
+        if self.use_read_into:
+            return self._read_into(path, buf, size, offset, fh)
+
+        ret = self._ops['read'](self._decode_optional_path(path), size,
+                                offset, fh)
+
+        if isinstance(ret, FileRegion):
+            ret = os.pread(ret.fd, min(ret.length, size), ret.offset)
+        elif type(ret) is FuseErrno:
+            return ret
 
         if not ret:
             return 0
@@ -855,20 +1924,125 @@ class FUSE(object):
         ctypes.memmove(buf, ret, retsize)
         return retsize
 
+    def _read_into(self, path, buf, size, offset, fh):
+        view = buffer_view(buf, size)
+        try:
+            retsize = self._ops['read_into'](self._decode_optional_path(path),
+                                             view, offset, fh) or 0
+        finally:
+            view.release()
+
+        assert retsize <= size, \
+            'actual amount read %d greater than expected %d' % (retsize, size)
+
+        return retsize
+
     def write(self, path, buf, size, offset, fip):
-        data = ctypes.string_at(buf, size)
+        if self.raw_fi:
+            fh = fip.contents
+        else:
+            fh = fip.contents.fh
+
+        if not self.write_memoryview:
+            data = ctypes.string_at(buf, size)
+            return self._ops['write'](self._decode_optional_path(path),
+                                      data, offset, fh)
+
+        data = buffer_view(buf, size, readonly=True)
+        try:
+            return self._ops['write'](self._decode_optional_path(path),
+                                      data, offset, fh)
+        finally:
+            data.release()
+
+    def read_buf(self, path, bufp, size, offset, fip):
+        if self.raw_fi:
+            fh = fip.contents
+        else:
+            fh = fip.contents.fh
+
+        if self.use_read_into:
+            ret = None
+        else:
+            ret = self._ops['read'](self._decode_optional_path(path), size,
+                                    offset, fh)
+            if type(ret) is FuseErrno:
+                return ret
+            if not ret:
+                ret = b''
+
+        bufv = ctypes.cast(_malloc(ctypes.sizeof(fuse_bufvec)),
+                           ctypes.POINTER(fuse_bufvec))
+        ctypes.memset(bufv, 0, ctypes.sizeof(fuse_bufvec))
+        bufv.contents.count = 1
+        buf = bufv.contents.buf[0]
+
+        try:
+            if isinstance(ret, FileRegion):
+                buf.size = min(ret.length, size)
+                buf.flags = FUSE_BUF_IS_FD | FUSE_BUF_FD_SEEK
+                buf.fd = ret.fd
+                buf.pos = ret.offset
+            elif self.use_read_into:
+                buf.mem = _malloc(size or 1)
+                retsize = self._read_into(path, buf.mem, size, offset, fh)
+                if retsize < 0:
+                    _libc.free(buf.mem)
+                    _libc.free(bufv)
+                    return retsize
+                buf.size = retsize
+            else:
+                retsize = len(ret)
+                assert retsize <= size, \
+                    'actual amount read %d greater than expected %d' % (
+                        retsize, size)
+
+                buf.mem = _malloc(retsize or 1)
+                buf.size = retsize
+                ctypes.memmove(buf.mem, ret, retsize)
+        except BaseException:
+            # libfuse only frees the buffers when read_buf succeeds
+            _libc.free(buf.mem)
+            _libc.free(bufv)
+            raise
+
+        bufp[0] = bufv
+        return 0
 
+    def write_buf(self, path, bufv, offset, fip):
         if self.raw_fi:
             fh = fip.contents
         else:
             fh = fip.contents.fh
 
-        return self.operations('write', self._decode_optional_path(path), data,
-                                        offset, fh)
+        size = _libfuse.fuse_buf_size(bufv)
+        ret = self._ops['write_buf'](self._decode_optional_path(path), size,
+                                     offset, fh)
+        if type(ret) is FuseErrno:
+            return ret
+
+        dst = fuse_bufvec(count=1)
+        if isinstance(ret, FileRegion):
+            dst.buf[0].size = min(ret.length, size)
+            dst.buf[0].flags = FUSE_BUF_IS_FD | FUSE_BUF_FD_SEEK
+            dst.buf[0].fd = ret.fd
+            dst.buf[0].pos = ret.offset
+            return _libfuse.fuse_buf_copy(ctypes.byref(dst), bufv, 0)
+
+        # Fall back to write with the data copied into memory
+        mem = ctypes.create_string_buffer(size)
+        dst.buf[0].size = size
+        dst.buf[0].mem = ctypes.addressof(mem)
+        retsize = _libfuse.fuse_buf_copy(ctypes.byref(dst), bufv, 0)
+        if retsize < 0:
+            return retsize
+        return self.write(path, mem, retsize, offset, fip)
 
     def statfs(self, path, buf):
         stv = buf.contents
-        attrs = self.operations('statfs', path.decode(self.encoding))
+        attrs = self._ops['statfs'](self._decode(path))
+        if type(attrs) is FuseErrno:
+            return attrs
         for key, val in attrs.items():
             if hasattr(stv, key):
                 setattr(stv, key, val)
@@ -881,7 +2055,7 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('flush', self._decode_optional_path(path), fh)
+        return self._ops['flush'](self._decode_optional_path(path), fh)
 
     def release(self, path, fip):
         if self.raw_fi:
@@ -889,7 +2063,7 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
-        return self.operations('release', self._decode_optional_path(path), fh)
+        return self._ops['release'](self._decode_optional_path(path), fh)
 
     def fsync(self, path, datasync, fip):
         if self.raw_fi:
@@ -897,21 +2071,61 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('fsync', self._decode_optional_path(path), datasync,
-                                        fh)
+        return self._ops['fsync'](self._decode_optional_path(path), datasync,
+                                  fh)
+
+    def _xattr_key(self, path, name=None):
+        '''
+        Returns the key the result of a size query for the xattr name of path
+        (or the list of xattrs if name is None) is remembered under. It
+        includes the pid of the caller, so that only its own fetch is served
+        from it and the operation still checks every other caller.
+        '''
+
+        try:
+            pid = fuse_get_context()[2]
+        except ValueError:
+            pid = 0     # not called by libfuse, e.g. under fusebench
+        return path, name, pid
+
+    def _probed_xattr(self, key):
+        '''
+        Returns the result remembered by a size query for key, if any. The
+        kernel asks for the size of an xattr (or list of xattrs) before
+        fetching it, so this saves a second call to the operation. The fetch
+        may be served by another thread than the query.
+        '''
+
+        return self._xattr_probe.pop(key)
+
+    def _forget_xattr(self, path, name):
+        self._xattr_probe.discard_matching(
+            lambda key: key[0] == path and key[1] in (name, None))
 
     def setxattr(self, path, name, value, size, options, *args):
-        return self.operations('setxattr', path.decode(self.encoding),
-                               name.decode(self.encoding),
-                               ctypes.string_at(value, size), options, *args)
+        try:
+            return self._ops['setxattr'](self._decode(path),
+                                         self._decode(name),
+                                         ctypes.string_at(value, size),
+                                         options, *args)
+        finally:
+            self._forget_xattr(path, name)
 
     def getxattr(self, path, name, value, size, *args):
-        ret = self.operations('getxattr', path.decode(self.encoding),
-                                          name.decode(self.encoding), *args)
+        # Only plain queries are remembered (not those at a position)
+        key = self._xattr_key(path, name) if not any(args) else None
+        ret = self._probed_xattr(key) if value and key else None
+        if ret is None:
+            ret = self._ops['getxattr'](self._decode(path),
+                                        self._decode(name), *args)
+            if type(ret) is FuseErrno:
+                return ret
 
         retsize = len(ret)
         # allow size queries
         if not value:
+            if key:
+                self._xattr_probe.set(key, ret)
             return retsize
 
         # do not truncate
@@ -919,90 +2133,190 @@ class FUSE(object):
             return -errno.ERANGE
 
         # Does not add trailing 0
-        buf = ctypes.create_string_buffer(ret, retsize)
-        ctypes.memmove(value, buf, retsize)
+        ctypes.memmove(value, ret, retsize)
 
         return retsize
 
     def listxattr(self, path, namebuf, size):
-        attrs = self.operations('listxattr', path.decode(self.encoding)) or ''
-        ret = '\x00'.join(attrs).encode(self.encoding)
-        if len(ret) > 0:
-            ret += '\x00'.encode(self.encoding)
+        key = self._xattr_key(path)
+        ret = self._probed_xattr(key) if namebuf else None
+        if ret is None:
+            attrs = self._ops['listxattr'](self._decode(path)) or ()
+            if type(attrs) is FuseErrno:
+                return attrs
+            ret = b'\x00'.join(self._encode(attr) for attr in attrs)
+            if len(ret) > 0:
+                ret += b'\x00'
 
         retsize = len(ret)
         # allow size queries
         if not namebuf:
+            self._xattr_probe.set(key, ret)
             return retsize
 
         # do not truncate
         if retsize > size:
             return -errno.ERANGE
 
-        buf = ctypes.create_string_buffer(ret, retsize)
-        ctypes.memmove(namebuf, buf, retsize)
+        ctypes.memmove(namebuf, ret, retsize)
 
         return retsize
 
     def removexattr(self, path, name):
-        return self.operations('removexattr', path.decode(self.encoding),
-                                              name.decode(self.encoding))
+        try:
+            return self._ops['removexattr'](self._decode(path),
+                                            self._decode(name))
+        finally:
+            self._forget_xattr(path, name)
 
     def opendir(self, path, fip):
         # Ignore raw_fi
-        fip.contents.fh = self.operations('opendir',
-                                          path.decode(self.encoding))
+        fh = self._ops['opendir'](self._decode(path))
+        if type(fh) is FuseErrno:
+            return fh
+
+        if self.stream_readdir:
+            cursor = _DirCursor(fh)
+            fh = next(self._dir_handles)
+            self._dir_cursors[fh] = cursor
 
+        fip.contents.fh = fh
         return 0
 
-    def readdir(self, path, buf, filler, offset, fip):
-        # Ignore raw_fi
-        for item in self.operations('readdir', self._decode_optional_path(path),
-                                               fip.contents.fh):
+    def _dir_fh(self, fip):
+        fh = fip.contents.fh
+        cursor = self._dir_cursors.get(fh)
+        return fh if cursor is None else cursor.fh
 
-            if isinstance(item, basestring):
-                name, st, offset = item, None, 0
-            else:
-                name, attrs, offset = item
-                if attrs:
-                    st = c_stat()
-                    set_st_attrs(st, attrs, use_ns=self.use_ns)
-                else:
-                    st = None
+    def _readdir_entry(self, item, st):
+        '''
+        Returns the (name, stat, offset) arguments for filler, reusing the
+        c_stat st for the attributes of every entry
+        '''
+
+        if isinstance(item, (basestring, bytes)):
+            return self._encode(item), None, 0
 
-            if filler(buf, name.encode(self.encoding), st, offset) != 0:
+        name, attrs, offset = item
+        if not attrs:
+            return self._encode(name), None, offset
+
+        size = ctypes.sizeof(st)
+        ctypes.memset(ctypes.addressof(st), 0, size)
+        if isinstance(attrs, bytes):
+            # Prepacked c_stat
+            ctypes.memmove(ctypes.addressof(st), attrs, min(len(attrs), size))
+        else:
+            set_st_attrs(st, attrs, use_ns=self.use_ns)
+
+        return self._encode(name), st, offset
+
+    def readdir(self, path, buf, filler, offset, fip):
+        # Ignore raw_fi
+        cursor = self._dir_cursors.get(fip.contents.fh)
+        if cursor is not None:
+            return self._readdir_cursor(path, buf, filler, offset, cursor)
+
+        entries = self._ops['readdir'](self._decode_optional_path(path),
+                                       fip.contents.fh)
+        if type(entries) is FuseErrno:
+            return entries
+
+        st = c_stat()
+        for item in entries:
+            name, stp, offset = self._readdir_entry(item, st)
+            if filler(buf, name, stp, offset) != 0:
                 break
 
         return 0
 
+    def _readdir_cursor(self, path, buf, filler, offset, cursor):
+        if cursor.entries is None or offset != cursor.offset:
+            # First call, or the directory stream was rewound or seeked
+            entries = self._ops['readdir'](self._decode_optional_path(path),
+                                           cursor.fh)
+            if type(entries) is FuseErrno:
+                return entries
+            cursor.entries = islice(entries, offset, None)
+            cursor.offset = offset
+            cursor.pending = None
+
+        item = cursor.pending
+        if item is None:
+            item = next(cursor.entries, None)
+
+        st = c_stat()
+        while item is not None:
+            name, stp, _ = self._readdir_entry(item, st)
+            if filler(buf, name, stp, cursor.offset + 1) != 0:
+                # The buffer is full, resume with this entry next time
+                cursor.pending = item
+                return 0
+
+            cursor.offset += 1
+            item = next(cursor.entries, None)
+
+        cursor.pending = None
+        return 0
+
     def releasedir(self, path, fip):
         # Ignore raw_fi
-        return self.operations('releasedir', self._decode_optional_path(path),
-                                             fip.contents.fh)
+        cursor = self._dir_cursors.pop(fip.contents.fh, None)
+        fh = fip.contents.fh if cursor is None else cursor.fh
+
+        return self._ops['releasedir'](self._decode_optional_path(path), fh)
 
     def fsyncdir(self, path, datasync, fip):
         # Ignore raw_fi
-        return self.operations('fsyncdir', self._decode_optional_path(path),
-                                           datasync, fip.contents.fh)
+        return self._ops['fsyncdir'](self._decode_optional_path(path),
+                                     datasync, self._dir_fh(fip))
 
     def init(self, conn):
-        return self.operations('init', '/')
+        self._fuse = _libfuse.fuse_get_context().contents.fuse
+
+        # Started here rather than before fuse_main_real, which may fork
+        if isinstance(self._ops.operations, AsyncOperations):
+            self._ops.operations.start_loop()
+        if self.stats_file:
+            self._stats_stop = Event()
+            self._stats_thread = Thread(target=self._stats_writer,
+                                        args=(self._stats_stop,),
+                                        name='fuse-stats')
+            self._stats_thread.daemon = True
+            self._stats_thread.start()
+        if self.use_conn_info:
+            return self._ops['init'](self._decode(b'/'), conn.contents)
+        return self._ops['init'](self._decode(b'/'))
 
     def destroy(self, private_data):
-        return self.operations('destroy', '/')
+        try:
+            return self._ops['destroy'](self._decode(b'/'))
+        finally:
+            if isinstance(self._ops.operations, AsyncOperations):
+                self._ops.operations.stop_loop()
+            if self._stats_stop is not None:
+                # Wait for the final write, which is lost if the process
+                # exits first
+                self._stats_stop.set()
+                self._stats_thread.join()
 
     def access(self, path, amode):
-        return self.operations('access', path.decode(self.encoding), amode)
+        return self._ops['access'](self._decode(path), amode)
 
     def create(self, path, mode, fip):
         fi = fip.contents
-        path = path.decode(self.encoding)
 
-        if self.raw_fi:
-            return self.operations('create', path, mode, fi)
-        else:
-            fi.fh = self.operations('create', path, mode)
-            return 0
+        try:
+            if self.raw_fi:
+                return self._ops['create'](self._decode(path), mode, fi)
+            else:
+                ret = self._ops['create'](self._decode(path), mode)
+                if type(ret) is FuseErrno:
+                    return ret
+                self._set_fh(fi, ret)
+                return 0
+        finally:
+            self._forget_missing(path)
 
     def ftruncate(self, path, length, fip):
         if self.raw_fi:
@@ -1010,8 +2324,8 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('truncate', self._decode_optional_path(path),
-                                           length, fh)
+        return self._ops['truncate'](self._decode_optional_path(path),
+                                     length, fh)
 
     def fgetattr(self, path, buf, fip):
         ctypes.memset(buf, 0, ctypes.sizeof(c_stat))
@@ -1024,7 +2338,33 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        attrs = self.operations('getattr', self._decode_optional_path(path), fh)
+        if self._negative is not None and path is not None:
+            return self._fgetattr_negative(path, st, fh)
+
+        attrs = self._ops['getattr'](self._decode_optional_path(path), fh)
+        if type(attrs) is FuseErrno:
+            return attrs
+        set_st_attrs(st, attrs, use_ns=self.use_ns)
+        return 0
+
+    def _fgetattr_negative(self, path, st, fh):
+        negative = self._negative
+        if negative.get(path):
+            return FuseErrno.ENOENT
+
+        # A path created while getattr runs must not be remembered as missing
+        generation = self._negative_generation
+        try:
+            attrs = self._ops['getattr'](self._decode(path), fh)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                self._remember_missing(path, generation)
+            raise
+
+        if type(attrs) is FuseErrno:
+            if attrs == FuseErrno.ENOENT:
+                self._remember_missing(path, generation)
+            return attrs
         set_st_attrs(st, attrs, use_ns=self.use_ns)
         return 0
 
@@ -1034,22 +2374,47 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('lock', self._decode_optional_path(path), fh, cmd,
-                                       lock)
+        return self._ops['lock'](self._decode_optional_path(path), fh, cmd,
+                                 lock)
 
     def utimens(self, path, buf):
         if buf:
-            atime = time_of_timespec(buf.contents.actime, use_ns=self.use_ns)
-            mtime = time_of_timespec(buf.contents.modtime, use_ns=self.use_ns)
+            atime = self._utime(buf.contents.actime)
+            mtime = self._utime(buf.contents.modtime)
             times = (atime, mtime)
         else:
             times = None
 
-        return self.operations('utimens', path.decode(self.encoding), times)
+        return self._ops['utimens'](self._decode(path), times)
+
+    def _utime(self, ts):
+        if self.utime_omit_ok:
+            if ts.tv_nsec == UTIME_OMIT:
+                return None
+            if ts.tv_nsec == UTIME_NOW:
+                now = time.time()
+                return int(now * 10 ** 9) if self.use_ns else now
+        return time_of_timespec(ts, use_ns=self.use_ns)
 
     def bmap(self, path, blocksize, idx):
-        return self.operations('bmap', path.decode(self.encoding), blocksize,
-                                       idx)
+        return self._ops['bmap'](self._decode(path), blocksize, idx)
+
+    def flock(self, path, fip, op):
+        if self.raw_fi:
+            fh = fip.contents
+        else:
+            fh = fip.contents.fh
+
+        return self._ops['flock'](self._decode_optional_path(path), fh, op)
+
+    def fallocate(self, path, mode, offset, length, fip):
+        if self.raw_fi:
+            fh = fip.contents
+        else:
+            fh = fip.contents.fh
+
+        return self._ops['fallocate'](self._decode_optional_path(path), mode,
+                                      offset, length, fh)
 
     def ioctl(self, path, cmd, arg, fip, flags, data):
         if self.raw_fi:
@@ -1057,19 +2422,35 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
-        return self.operations('ioctl', path.decode(self.encoding),
+        return self._ops['ioctl'](self._decode_optional_path(path),
             cmd, arg, fh, flags, data)
 
 class Operations(object):
     '''
     This class should be subclassed and passed as an argument to FUSE on
     initialization. All operations should raise a FuseOSError exception on
-    error.
+    error, or return a FuseErrno for errors that are expected to be common.
 
     When in doubt of what an operation should do, check the FUSE header file
     or the corresponding system call man page.
     '''
 
+    # The FUSE instance serving this object while it is mounted, so that
+    # threads started from init can call e.g.
+    # self.fuse_instance.invalidate(path)
+    fuse_instance = None
+
+    # Flags copied to fuse_operations. Set flag_nullpath_ok if the operations
+    # that take a file handle (read, write, flush, release, fsync, ftruncate,
+    # fgetattr, lock, ioctl, readdir, releasedir and fsyncdir) can do without
+    # their path, which is then None for open files that have been unlinked.
+    # Set flag_nopath as well to stop libfuse from building the path for
+    # those operations altogether, so that they always get None. Set
+    # flag_utime_omit_ok if utimens handles omitted times itself.
+    flag_nullpath_ok = False
+    flag_nopath = False
+    flag_utime_omit_ok = False
+
     def __call__(self, op, *args):
         if not hasattr(self, op):
             raise FuseOSError(errno.EFAULT)
@@ -1089,7 +2470,7 @@ class Operations(object):
     def create(self, path, mode, fi=None):
         '''
         When raw_fi is False (default case), fi is None and create should
-        return a numerical file handle.
+        return a numerical file handle or an OpenResult.
 
         When raw_fi is True the file handle should be set directly by create
         and return 0.
@@ -1102,6 +2483,12 @@ class Operations(object):
 
         pass
 
+    # fallocate(self, path, mode, offset, length, fh)
+    fallocate = None
+
+    # flock(self, path, fh, op)
+    flock = None
+
     def flush(self, path, fh):
         return 0
 
@@ -1118,22 +2505,36 @@ class Operations(object):
 
         st_atime, st_mtime and st_ctime should be floats.
 
+        An os.stat_result, a c_stat or a tuple of the values named in
+        STAT_FIELDS may be returned instead of a dictionary; these are copied
+        into the kernel buffer without a per-field lookup.
+
         NOTE: There is an incompatibility between Linux and Mac OS X
         concerning st_nlink of directories. Mac OS X counts all files inside
         the directory, while Linux counts only the subdirectories.
         '''
 
-        if path != '/':
+        if path not in ('/', b'/'):  # b'/' with bytes_paths
             raise FuseOSError(errno.ENOENT)
         return dict(st_mode=(S_IFDIR | 0o755), st_nlink=2)
 
     def getxattr(self, path, name, position=0):
         raise FuseOSError(ENOTSUP)
 
-    def init(self, path):
+    # Pass the fuse_conn_info negotiated with the kernel to init as a second
+    # argument. Set its max_write, max_readahead, max_background and want
+    # fields there to change them, e.g.
+    #
+    #   conn.want |= conn.capable & FUSE_CAP_BIG_WRITES
+    #   conn.max_write = 128 * 1024
+    use_conn_info = False
+
+    def init(self, path, conn=None):
         '''
         Called on filesystem initialization. (Path is always /)
 
+        conn is the fuse_conn_info structure if use_conn_info is set.
+
         Use it instead of __init__ if you start threads on initialization.
         '''
 
@@ -1161,7 +2562,8 @@ class Operations(object):
     def open(self, path, flags):
         '''
         When raw_fi is False (default case), open should return a numerical
-        file handle.
+        file handle, or an OpenResult to also set direct_io, keep_cache or
+        nonseekable for the opened file.
 
         When raw_fi is True the signature of open becomes:
             open(self, path, fi)
@@ -1177,14 +2579,38 @@ class Operations(object):
         return 0
 
     def read(self, path, size, offset, fh):
-        'Returns a string containing the data requested.'
+        '''
+        Returns a string containing the data requested, or a FileRegion
+        naming where to read it from.
+        '''
 
         raise FuseOSError(errno.EIO)
 
+    # Serve reads through the read_buf operation of libfuse 2.9 or later, so
+    # that a FileRegion returned by read is spliced to the kernel from its
+    # file descriptor instead of being read into Python.
+    use_read_buf = False
+
+    # read_into(self, path, buf, offset, fh)
+    #
+    # Optional zero-copy variant of read. When defined it is called instead of
+    # read with buf being a writable memoryview over the kernel buffer; fill
+    # it (e.g. with os.preadv or file.readinto) and return the number of
+    # bytes read. buf is only valid until read_into returns.
+    read_into = None
+
     def readdir(self, path, fh):
         '''
         Can return either a list of names, or a list of (name, attrs, offset)
-        tuples. attrs is a dict as in getattr.
+        tuples. attrs is a dict or any of the other types getattr may return,
+        or the bytes of a packed c_stat (e.g. bytes(st) of a c_stat st).
+
+        Names given as bytes are passed to the kernel as they are, so an
+        iterable of (bytes name, packed c_stat bytes, offset) records is
+        handed to the kernel without any per-entry conversion.
+
+        With FUSE(..., stream_readdir=True) any iterable (e.g. a generator)
+        works well, since it is consumed incrementally across calls.
         '''
 
         return ['.', '..']
@@ -1233,13 +2659,121 @@ class Operations(object):
         raise FuseOSError(errno.EROFS)
 
     def utimens(self, path, times=None):
-        'Times is a (atime, mtime) tuple. If None use current time.'
+        '''
+        Times is a (atime, mtime) tuple. If None use current time.
+
+        If flag_utime_omit_ok is set, either time is None when it should be
+        left unchanged.
+        '''
 
         return 0
 
     def write(self, path, data, offset, fh):
+        '''
+        Returns the number of bytes written.
+
+        data is a bytes object unless write_memoryview is set to True on the
+        operations class, in which case it is a read-only memoryview over the
+        kernel buffer that is only valid until write returns.
+        '''
+
         raise FuseOSError(errno.EROFS)
 
+    # write_buf(self, path, size, offset, fh)
+    #
+    # Optional, for libfuse 2.9 or later. Called before size bytes are written
+    # at offset; return a FileRegion to have libfuse copy (or splice) the data
+    # straight to its file descriptor and return the number of bytes written,
+    # or None to have write called with the data as usual.
+    write_buf = None
+
+
+class AsyncOperations(Operations):
+    '''
+    Like Operations, but any operation may be a coroutine function.
+
+    Coroutines run on an asyncio event loop in a thread of its own, which
+    FUSE starts before init and stops after destroy. The libfuse threads that
+    receive the requests submit them to the loop and block until they
+    complete, so a backend that spends most of its time waiting on the network
+    can have many requests in flight on a single thread. Operations that are
+    plain functions still run on the libfuse thread. Use the nothreads
+    option to serve one request at a time.
+
+    Mix-ins that override __call__, like LoggingMixIn, see the coroutine
+    rather than the value it returns. AttrCacheMixIn, BlockCacheMixIn and
+    DiskBlockCacheMixIn wait for the coroutines of the methods they extend on
+    the libfuse thread.
+    '''
+
+    loop = None
+    _loop_thread = None
+
+    def start_loop(self):
+        'Starts the event loop thread if it is not running yet'
+
+        if self.loop is not None:
+            return
+        if asyncio is None:
+            raise RuntimeError('AsyncOperations requires asyncio')
+
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = Thread(target=self.loop.run_forever,
+                                   name='fuse-asyncio')
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+
+    def stop_loop(self):
+        'Stops the event loop thread and closes the loop'
+
+        loop, self.loop = self.loop, None
+        if loop is None:
+            return
+
+        loop.call_soon_threadsafe(loop.stop)
+        self._loop_thread.join()
+        self._loop_thread = None
+        loop.close()
+
+    def run_coroutine(self, coro):
+        'Runs coro on the event loop and waits for its result'
+
+        loop = self.loop
+        if loop is None:
+            coro.close()
+            raise FuseOSError(errno.EIO)
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def blocking(self, func):
+        '''
+        Returns a function that calls func and, if it returns a coroutine,
+        waits for it on the event loop.
+        '''
+
+        def wrapper(*args):
+            ret = func(*args)
+            if asyncio.iscoroutine(ret):
+                return self.run_coroutine(ret)
+            return ret
+
+        return wrapper
+
+    def __call__(self, op, *args):
+        return self.blocking(super(AsyncOperations, self).__call__)(op, *args)
+
+
+def _resolve(operations, ret):
+    '''
+    Returns ret, or if it is a coroutine of the AsyncOperations operations,
+    its result. Used by the caching mix-ins on the results of the methods
+    they extend, which may be coroutine functions.
+    '''
+
+    if asyncio is not None and asyncio.iscoroutine(ret) and \
+            isinstance(operations, AsyncOperations):
+        return operations.run_coroutine(ret)
+    return ret
+
 
 class LoggingMixIn:
     log = logging.getLogger('fuse.log-mixin')
@@ -1255,3 +2789,1259 @@ class LoggingMixIn:
             raise
         finally:
             self.log.debug('<- %s %s', op, repr(ret))
+
+
+class _ExpiringCache(object):
+    'A thread safe LRU mapping whose entries expire after timeout seconds'
+
+    def __init__(self, maxsize, timeout):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._fetches = {}      # key -> [generation, fetches in progress]
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def fetch(self, key):
+        '''
+        Returns the generation of key before its value is looked up, to be
+        passed to set, and then to done once the lookup has finished. Values
+        of a generation that was discarded in the meantime are not cached.
+        '''
+
+        with self._lock:
+            fetch = self._fetches.get(key)
+            if fetch is None:
+                fetch = self._fetches[key] = [0, 0]
+            fetch[1] += 1
+            return fetch[0]
+
+    def done(self, key):
+        with self._lock:
+            fetch = self._fetches[key]
+            fetch[1] -= 1
+            if not fetch[1]:
+                del self._fetches[key]
+
+    def get(self, key, default=None):
+        now = _monotonic()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return default
+
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def pop(self, key, default=None):
+        'Removes key and returns its value if it has not expired'
+
+        now = _monotonic()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                return default
+            return entry[1]
+
+    def set(self, key, value, generation=None):
+        expires = _monotonic() + self.timeout
+        with self._lock:
+            if generation is not None and \
+                    self._fetches[key][0] != generation:
+                return
+
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                fetch = self._fetches.get(key)
+                if fetch is not None:
+                    fetch[0] += 1
+
+    def discard_matching(self, match):
+        'Discards every key for which match(key) is true'
+
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                del self._entries[key]
+            for key, fetch in self._fetches.items():
+                if match(key):
+                    fetch[0] += 1
+
+    def discard_tree(self, path):
+        'Discards path and every path below it'
+
+        prefix = path + (b'/' if isinstance(path, bytes) else '/')
+        with self._lock:
+            self._entries.pop(path, None)
+            for key in [key for key in self._entries
+                        if key.startswith(prefix)]:
+                del self._entries[key]
+            for key, fetch in self._fetches.items():
+                if key == path or key.startswith(prefix):
+                    fetch[0] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for fetch in self._fetches.values():
+                fetch[0] += 1
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self))
+
+
+class AttrCacheMixIn(object):
+    '''
+    Caches getattr results per path for attr_cache_timeout seconds, keeping
+    at most attr_cache_size entries.
+
+    Entries are invalidated by the operations of this mount that change
+    attributes, so this is only safe if nothing else modifies the backing
+    store, or if attr_cache_timeout is short enough to tolerate it. Paths are
+    required, so do not combine it with flag_nopath.
+
+    It must come before the class implementing the operations in the bases,
+    e.g. class Cached(AttrCacheMixIn, MyOperations), as methods defined in
+    the class body itself hide those of the mix-in.
+    '''
+
+    attr_cache_timeout = 1.0
+    attr_cache_size = 10000
+
+    _attr_cache_lock = Lock()
+
+    @property
+    def attr_cache(self):
+        try:
+            return self.__dict__['_attr_cache']
+        except KeyError:
+            with self._attr_cache_lock:
+                return self.__dict__.setdefault('_attr_cache', _ExpiringCache(
+                    self.attr_cache_size, self.attr_cache_timeout))
+
+    def attr_cache_stats(self):
+        'Returns a dict with the hits, misses and size of the cache'
+
+        return self.attr_cache.stats()
+
+    def _invalidate_attrs(self, *paths):
+        self.attr_cache.discard(*(path for path in paths if path is not None))
+
+    def getattr(self, path, fh=None):
+        if path is None:
+            return _resolve(self, super(AttrCacheMixIn, self).getattr(
+                path, fh))
+
+        cache = self.attr_cache
+        attrs = cache.get(path)
+        if attrs is None:
+            # A modification finishing meanwhile must not be overwritten
+            generation = cache.fetch(path)
+            try:
+                attrs = _resolve(self, super(AttrCacheMixIn, self).getattr(
+                    path, fh))
+                if type(attrs) is not FuseErrno:
+                    cache.set(path, attrs, generation)
+            finally:
+                cache.done(path)
+
+        return attrs
+
+    def chmod(self, path, mode):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).chmod(
+                path, mode))
+        finally:
+            self._invalidate_attrs(path)
+
+    def chown(self, path, uid, gid):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).chown(
+                path, uid, gid))
+        finally:
+            self._invalidate_attrs(path)
+
+    def create(self, path, mode, *args):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).create(
+                path, mode, *args))
+        finally:
+            self._invalidate_attrs(path, posixpath.dirname(path))
+
+    @property
+    def fallocate(self):
+        fallocate = super(AttrCacheMixIn, self).fallocate
+        if fallocate is None:
+            return None
+
+        def invalidating(path, mode, offset, length, fh):
+            try:
+                return _resolve(self,
+                                fallocate(path, mode, offset, length, fh))
+            finally:
+                self._invalidate_attrs(path)
+
+        return invalidating
+
+    def link(self, target, source):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).link(
+                target, source))
+        finally:
+            self._invalidate_attrs(target, posixpath.dirname(target), source)
+
+    def mkdir(self, path, mode):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).mkdir(
+                path, mode))
+        finally:
+            self._invalidate_attrs(path, posixpath.dirname(path))
+
+    def mknod(self, path, mode, dev):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).mknod(
+                path, mode, dev))
+        finally:
+            self._invalidate_attrs(path, posixpath.dirname(path))
+
+    def rename(self, old, new):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).rename(old, new))
+        finally:
+            # Renaming a directory changes the path of everything below it
+            self.attr_cache.discard_tree(old)
+            self.attr_cache.discard_tree(new)
+            self._invalidate_attrs(posixpath.dirname(old),
+                                   posixpath.dirname(new))
+
+    def rmdir(self, path):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).rmdir(path))
+        finally:
+            self._invalidate_attrs(path, posixpath.dirname(path))
+
+    def symlink(self, target, source):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).symlink(
+                target, source))
+        finally:
+            self._invalidate_attrs(target, posixpath.dirname(target))
+
+    def truncate(self, path, length, fh=None):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).truncate(
+                path, length, fh))
+        finally:
+            self._invalidate_attrs(path)
+
+    def unlink(self, path):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).unlink(path))
+        finally:
+            self._invalidate_attrs(path, posixpath.dirname(path))
+
+    def utimens(self, path, times=None):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).utimens(
+                path, times))
+        finally:
+            self._invalidate_attrs(path)
+
+    def write(self, path, data, offset, fh):
+        try:
+            return _resolve(self, super(AttrCacheMixIn, self).write(
+                path, data, offset, fh))
+        finally:
+            self._invalidate_attrs(path)
+
+    @property
+    def write_buf(self):
+        write_buf = super(AttrCacheMixIn, self).write_buf
+        if write_buf is None:
+            return None
+
+        def invalidating(path, size, offset, fh):
+            # The data is copied to a returned FileRegion after this, so a
+            # getattr in between may cache the old size until it expires
+            try:
+                return _resolve(self, write_buf(path, size, offset, fh))
+            finally:
+                self._invalidate_attrs(path)
+
+        return invalidating
+
+
+class _BlockCache(object):
+    '''
+    A thread safe LRU mapping of (path, block index) to block data, holding
+    at most maxbytes bytes of data, with hit statistics per path. The
+    statistics of a path are dropped once all its blocks are evicted.
+    '''
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._files = {}        # path -> set of cached block indexes
+        self._file_stats = {}   # path -> [hits, misses]
+        self._fetches = {}      # path -> [generation, fetches in progress]
+        self._lock = Lock()
+
+    def fetch(self, path):
+        '''
+        Returns the generation of path before its blocks are read, to be
+        passed to set, and then to done once the read has finished. Blocks of
+        a generation that was invalidated in the meantime are not cached.
+        '''
+
+        with self._lock:
+            fetch = self._fetches.get(path)
+            if fetch is None:
+                fetch = self._fetches[path] = [0, 0]
+            fetch[1] += 1
+            return fetch[0]
+
+    def done(self, path):
+        with self._lock:
+            fetch = self._fetches[path]
+            fetch[1] -= 1
+            if not fetch[1]:
+                del self._fetches[path]
+
+    def _invalidate_fetches(self, path, prefix=None):
+        for name, fetch in self._fetches.items():
+            if name == path or (prefix and name.startswith(prefix)):
+                fetch[0] += 1
+
+    def get(self, path, idx):
+        with self._lock:
+            block = self._blocks.pop((path, idx), None)
+            if block is not None:
+                self._blocks[path, idx] = block
+                self.hits += 1
+                self._file_stats[path][0] += 1
+            return block
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._blocks
+
+    def set(self, path, idx, block, generation):
+        '''
+        Records a miss of block idx of path, and caches the block read unless
+        path was invalidated since generation was returned by fetch
+        '''
+
+        with self._lock:
+            self.misses += 1
+            stats = self._file_stats.setdefault(path, [0, 0])
+            stats[1] += 1
+            if len(block) > self.maxbytes or \
+                    self._fetches[path][0] != generation:
+                return
+
+            old = self._blocks.pop((path, idx), None)
+            if old is not None:
+                self.size -= len(old)
+            self._blocks[path, idx] = block
+            self._files.setdefault(path, set()).add(idx)
+            self.size += len(block)
+
+            while self.size > self.maxbytes:
+                (old_path, old_idx), old = self._blocks.popitem(last=False)
+                self.size -= len(old)
+                self._forget(old_path, old_idx)
+                if old_path not in self._files:
+                    self._file_stats.pop(old_path, None)
+
+    def _forget(self, path, idx):
+        indexes = self._files.get(path)
+        if indexes is not None:
+            indexes.discard(idx)
+            if not indexes:
+                del self._files[path]
+
+    def discard(self, path, start=0, end=None, blocksize=None):
+        '''
+        Discards the blocks of path from index start up to (but excluding)
+        end, or to the end of the file if end is None. Blocks before start
+        shorter than blocksize (i.e. the end of the file) are discarded too,
+        since they are stale once the file grows.
+        '''
+
+        with self._lock:
+            self._invalidate_fetches(path)
+            for idx in list(self._files.get(path, ())):
+                if start <= idx and (end is None or idx < end):
+                    pass
+                elif idx < start and blocksize is not None and \
+                        len(self._blocks[path, idx]) < blocksize:
+                    pass
+                else:
+                    continue
+
+                self.size -= len(self._blocks.pop((path, idx)))
+                self._forget(path, idx)
+
+    def discard_tree(self, path):
+        'Discards the blocks and statistics of path and every path below it'
+
+        prefix = path + (b'/' if isinstance(path, bytes) else '/')
+        with self._lock:
+            self._invalidate_fetches(path, prefix)
+            for name in [name for name in self._files
+                         if name == path or name.startswith(prefix)]:
+                for idx in self._files.pop(name):
+                    self.size -= len(self._blocks.pop((name, idx)))
+            for name in [name for name in self._file_stats
+                         if name == path or name.startswith(prefix)]:
+                del self._file_stats[name]
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._files.clear()
+            self._file_stats.clear()
+            self.size = 0
+
+    def stats(self, path=None):
+        with self._lock:
+            if path is not None:
+                hits, misses = self._file_stats.get(path, (0, 0))
+                return dict(hits=hits, misses=misses,
+                            hit_rate=_hit_rate(hits, misses),
+                            blocks=len(self._files.get(path, ())))
+
+            return dict(hits=self.hits, misses=self.misses,
+                        hit_rate=_hit_rate(self.hits, self.misses),
+                        blocks=len(self._blocks), size=self.size)
+
+
+def _hit_rate(hits, misses):
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+class BlockCacheMixIn(object):
+    '''
+    Caches the data returned by read in aligned blocks of block_cache_block
+    bytes, keeping the most recently used blocks up to block_cache_size bytes
+    in memory. Reads are served from the cached blocks, and only runs of
+    missing blocks are read from the operations below, one read per run.
+
+    If the operations below define read_into, missing blocks are read with
+    it, and read_into is served from the cache too (with one more copy).
+
+    write, fallocate, truncate, create, unlink and rename through this mount
+    invalidate the affected blocks, so this is only safe if nothing else
+    modifies the backing store. write_buf of the operations below is not
+    used, so that writes are always seen by the cache once they completed.
+    '''
+
+    block_cache_block = 128 * 1024
+    block_cache_size = 64 * 1024 * 1024
+
+    _block_cache_lock = Lock()
+
+    @property
+    def block_cache(self):
+        try:
+            return self.__dict__['_block_cache']
+        except KeyError:
+            with self._block_cache_lock:
+                return self.__dict__.setdefault(
+                    '_block_cache', _BlockCache(self.block_cache_size))
+
+    def block_cache_stats(self, path=None):
+        '''
+        Returns a dict with the hits, misses and hit rate of the cache, and
+        the number of blocks and bytes cached. If path is given, the hits,
+        misses and hit rate of reads of that file and its cached blocks.
+        '''
+
+        return self.block_cache.stats(path)
+
+    def read(self, path, size, offset, fh):
+        if path is None or size <= 0:
+            return self._block_cache_fetch(path, size, offset, fh)
+
+        cache = self.block_cache
+        bs = self.block_cache_block
+        first = offset // bs
+        last = (offset + size - 1) // bs
+
+        blocks = []
+        idx = first
+        while idx <= last:
+            block = cache.get(path, idx)
+            if block is not None:
+                blocks.append(block)
+                idx += 1
+                if len(block) < bs:
+                    break       # end of file
+                continue
+
+            # Read the run of missing blocks starting here at once
+            end = idx + 1
+            while end <= last and (path, end) not in cache:
+                end += 1
+
+            generation = cache.fetch(path)
+            try:
+                data = self._block_cache_fetch(path, (end - idx) * bs,
+                                               idx * bs, fh)
+                if type(data) is FuseErrno:
+                    return data
+
+                for i in range(idx, end):
+                    block = data[(i - idx) * bs:(i - idx + 1) * bs]
+                    cache.set(path, i, block, generation)
+                    blocks.append(block)
+                    if len(block) < bs:
+                        break
+            finally:
+                cache.done(path)
+
+            if len(blocks[-1]) < bs:
+                break
+            idx = end
+
+        start = offset - first * bs
+        return b''.join(blocks)[start:start + size]
+
+    def _block_cache_fetch(self, path, size, offset, fh):
+        read_into = super(BlockCacheMixIn, self).read_into
+        if read_into is not None:
+            buf = bytearray(size)
+            ret = _resolve(self, read_into(path, memoryview(buf), offset, fh))
+            if type(ret) is FuseErrno:
+                return ret
+            return bytes(buf[:ret or 0])
+
+        data = _resolve(self, super(BlockCacheMixIn, self).read(
+            path, size, offset, fh))
+        if isinstance(data, FileRegion):
+            return os.pread(data.fd, min(data.length, size), data.offset)
+        if type(data) is FuseErrno:
+            return data
+        return bytes(data or b'')
+
+    @property
+    def read_into(self):
+        if super(BlockCacheMixIn, self).read_into is None:
+            return None
+
+        def read_into(path, buf, offset, fh):
+            data = self.read(path, len(buf), offset, fh)
+            if type(data) is FuseErrno:
+                return data
+            buf[:len(data)] = data
+            return len(data)
+
+        return read_into
+
+    def _invalidate_blocks(self, path, offset=0, length=None):
+        if path is None:
+            return
+
+        bs = self.block_cache_block
+        end = None if length is None else (offset + length + bs - 1) // bs
+        self.block_cache.discard(path, offset // bs, end, bs)
+
+    def create(self, path, mode, *args):
+        try:
+            return _resolve(self, super(BlockCacheMixIn, self).create(
+                path, mode, *args))
+        finally:
+            self.block_cache.discard_tree(path)
+
+    @property
+    def fallocate(self):
+        fallocate = super(BlockCacheMixIn, self).fallocate
+        if fallocate is None:
+            return None
+
+        def invalidating(path, mode, offset, length, fh):
+            try:
+                return _resolve(self,
+                                fallocate(path, mode, offset, length, fh))
+            finally:
+                self._invalidate_blocks(path, offset, length)
+
+        return invalidating
+
+    def rename(self, old, new):
+        try:
+            return _resolve(self, super(BlockCacheMixIn, self).rename(
+                old, new))
+        finally:
+            self.block_cache.discard_tree(old)
+            self.block_cache.discard_tree(new)
+
+    def truncate(self, path, length, fh=None):
+        try:
+            return _resolve(self, super(BlockCacheMixIn, self).truncate(
+                path, length, fh))
+        finally:
+            self._invalidate_blocks(path, length)
+
+    def unlink(self, path):
+        try:
+            return _resolve(self, super(BlockCacheMixIn, self).unlink(path))
+        finally:
+            self.block_cache.discard_tree(path)
+
+    def write(self, path, data, offset, fh):
+        try:
+            return _resolve(self, super(BlockCacheMixIn, self).write(
+                path, data, offset, fh))
+        finally:
+            self._invalidate_blocks(path, offset, len(data))
+
+    # libfuse copies the data to a FileRegion returned by write_buf only after
+    # it returns, too late to invalidate the blocks, so write is used instead
+    write_buf = None
+
+
+# Header of the index of a file in a DiskBlockCacheMixIn cache directory:
+# magic, block size, file size, mtime (seconds and nanoseconds) and length of
+# the path, followed by the path and a bitmap of the cached blocks
+_DISK_CACHE_MAGIC = b'FUSEDC01'
+_disk_cache_header = struct.Struct('<8sIQqqH')
+
+def _clear_bits(bitmap, start, end):
+    'Clears the bits start to end (excluded) of the bytearray bitmap'
+
+    end = min(end, len(bitmap) * 8)
+    while start < end and start & 7:
+        bitmap[start >> 3] &= 0xFF ^ (1 << (start & 7))
+        start += 1
+    stop = end & ~7
+    if start < stop:
+        bitmap[start >> 3:stop >> 3] = bytearray((stop - start) >> 3)
+        start = stop
+    while start < end:
+        bitmap[start >> 3] &= 0xFF ^ (1 << (start & 7))
+        start += 1
+
+
+class _DiskCacheFile(object):
+    'The sparse data file, block bitmap and mapping of a disk cached file'
+
+    def __init__(self, name, path, used=0):
+        self.name = name
+        self.path = path
+        self.used = used        # bytes allocated on disk by the data file
+        self.users = 0
+        self.lock = Lock()
+        self.fd = None
+        self.mm = None
+        self.bitmap = bytearray()
+        self.size = 0
+        self.mtime = None
+        self.generation = 0
+        self.dirty = False
+        self.stale = False      # modified through the mount since validated
+
+    def has(self, idx):
+        return idx >> 3 < len(self.bitmap) and \
+            self.bitmap[idx >> 3] >> (idx & 7) & 1
+
+    def add(self, idx):
+        self.bitmap[idx >> 3] |= 1 << (idx & 7)
+
+
+class _DiskCache(object):
+    '''
+    A directory of sparse files caching blocks of the files of a mount, each
+    with an index of the blocks present. The least recently used files are
+    deleted once the data files take more than maxbytes on disk. Indexes are
+    persisted by flush, or by flush_due every sync_interval seconds.
+    '''
+
+    def __init__(self, root, blocksize, maxbytes, sync_interval=60.0,
+                 encoding='utf-8'):
+        if root is None:
+            raise ValueError('disk_cache_dir is not set')
+        if not hasattr(os, 'pwrite'):
+            raise NotImplementedError('the disk cache requires POSIX')
+
+        self.root = root
+        self.blocksize = blocksize
+        self.maxbytes = maxbytes
+        self.sync_interval = sync_interval
+        self.encoding = encoding
+        self._next_sync = _monotonic() + sync_interval
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._files = OrderedDict()     # name -> _DiskCacheFile, oldest first
+        self._lock = Lock()
+
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self._load()
+
+    def _file(self, name, ext):
+        return os.path.join(self.root, name + ext)
+
+    def _key(self, path):
+        'Returns the encoded path and the name of its cache files'
+
+        if not isinstance(path, bytes):
+            path = path.encode(self.encoding)
+        return path, sha1(path).hexdigest()
+
+    def _load(self):
+        'Adds the files cached by earlier mounts, least recently used first'
+
+        found = []
+        names = os.listdir(self.root)
+        for fname in names:
+            name, ext = os.path.splitext(fname)
+            if ext == '.tmp':
+                self._unlink(fname)
+            elif ext == '.idx':
+                try:
+                    path = self._read_index(name)[3]
+                    used = os.stat(self._file(name, '.data')).st_blocks * 512
+                    atime = os.stat(self._file(name, '.idx')).st_mtime
+                except (IOError, OSError, ValueError):
+                    self._remove(name)
+                    continue
+                found.append((atime, name, path, used))
+
+        for atime, name, path, used in sorted(found):
+            self._files[name] = _DiskCacheFile(name, path, used)
+            self.size += used
+
+        for fname in names:
+            name, ext = os.path.splitext(fname)
+            if ext == '.data' and name not in self._files:
+                self._unlink(fname)
+
+        with self._lock:
+            self._evict()
+
+    def _unlink(self, fname):
+        try:
+            os.unlink(os.path.join(self.root, fname))
+        except OSError:
+            pass
+
+    def _remove(self, name):
+        self._unlink(name + '.idx')
+        self._unlink(name + '.data')
+
+    def _read_index(self, name):
+        'Returns the (blocksize, size, mtime, path, bitmap) index of name'
+
+        with open(self._file(name, '.idx'), 'rb') as f:
+            data = f.read()
+
+        offset = _disk_cache_header.size
+        if len(data) < offset:
+            raise ValueError('truncated index')
+        magic, blocksize, size, sec, nsec, length = \
+            _disk_cache_header.unpack_from(data)
+        if magic != _DISK_CACHE_MAGIC or not blocksize:
+            raise ValueError('not a disk cache index')
+
+        path = data[offset:offset + length]
+        bitmap = bytearray(data[offset + length:])
+        if len(bitmap) != (size + blocksize * 8 - 1) // (blocksize * 8):
+            raise ValueError('truncated index')
+
+        return blocksize, size, (sec, nsec), path, bitmap
+
+    def _write_index(self, entry):
+        'Syncs the data of entry, then atomically replaces its index'
+
+        os.fsync(entry.fd)
+
+        index = self._file(entry.name, '.idx')
+        with open(index + '.tmp', 'wb') as f:
+            f.write(_disk_cache_header.pack(
+                _DISK_CACHE_MAGIC, self.blocksize, entry.size, entry.mtime[0],
+                entry.mtime[1], len(entry.path)))
+            f.write(entry.path)
+            f.write(entry.bitmap)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(index + '.tmp', index)
+        entry.dirty = False
+
+    def acquire(self, path, stat):
+        '''
+        Returns the cache file of path, to be given back with release. The
+        first time it is used, or after being modified, it is validated
+        against stat(), which returns the (size, mtime) of path or None if
+        path cannot be cached (and then None is returned).
+        '''
+
+        key, name = self._key(path)
+        with self._lock:
+            entry = self._files.pop(name, None)
+            if entry is None:
+                entry = _DiskCacheFile(name, key)
+            self._files[name] = entry
+            entry.users += 1
+
+        used = None
+        valid = True
+        try:
+            with entry.lock:
+                if entry.fd is None or entry.stale or entry.mtime is None:
+                    current = stat()
+                    if current is None:
+                        valid = False
+                    else:
+                        self._validate(entry, *current)
+                        used = os.fstat(entry.fd).st_blocks * 512
+        except BaseException:
+            self.release(entry)
+            raise
+
+        if not valid:
+            # Not cacheable (any more), e.g. because it no longer exists
+            with self._lock:
+                entry.users -= 1
+                if not entry.users and self._files.get(name) is entry:
+                    self._drop(entry)
+            return None
+
+        if used is not None:
+            self._account(entry, 0, 0, used)
+        return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.users -= 1
+
+    def _validate(self, entry, size, mtime):
+        bs = self.blocksize
+        if entry.fd is None:
+            try:
+                blocksize, isize, imtime, ipath, bitmap = \
+                    self._read_index(entry.name)
+                if (blocksize, ipath) == (bs, entry.path):
+                    entry.size, entry.mtime, entry.bitmap = \
+                        isize, imtime, bitmap
+                os.utime(self._file(entry.name, '.idx'), None)
+            except (IOError, OSError, ValueError):
+                pass
+            entry.fd = os.open(self._file(entry.name, '.data'),
+                               os.O_RDWR | os.O_CREAT, 0o600)
+
+        if (size, mtime) == (entry.size, entry.mtime) and entry.mm is not None:
+            entry.stale = False
+            return
+
+        if (size, mtime) != (entry.size, entry.mtime):
+            if entry.stale and entry.mtime is not None:
+                # Changed through the mount, where written blocks have been
+                # invalidated; only a partial last block may be outdated
+                keep = min(entry.size, size) // bs
+            else:
+                keep = 0
+                os.ftruncate(entry.fd, 0)
+
+            _clear_bits(entry.bitmap, keep, len(entry.bitmap) * 8)
+            nbytes = (size + bs * 8 - 1) // (bs * 8)
+            entry.bitmap = entry.bitmap[:nbytes] + \
+                bytearray(max(0, nbytes - len(entry.bitmap)))
+            entry.size, entry.mtime = size, mtime
+            entry.generation += 1
+            entry.dirty = True
+
+        os.ftruncate(entry.fd, size)
+        if entry.mm is not None:
+            entry.mm.close()
+        entry.mm = mmap.mmap(entry.fd, size) if size else None
+        entry.stale = False
+
+    def read_into(self, entry, buf, offset, fetch):
+        '''
+        Fills buf with the data of entry from offset on, reading the runs of
+        missing blocks with fetch(size, offset). Returns the number of bytes
+        read, or the FuseErrno returned by fetch.
+        '''
+
+        bs = self.blocksize
+        hits = misses = 0
+        used = None
+        with entry.lock:
+            end = min(offset + len(buf), entry.size)
+        if end <= offset:
+            return 0
+
+        idx = offset // bs
+        last = (end - 1) // bs
+        try:
+            while idx <= last:
+                with entry.lock:
+                    run = idx
+                    while run <= last and run * bs < entry.size and \
+                            entry.has(run):
+                        run += 1
+                    if run > idx:
+                        start = max(offset, idx * bs)
+                        stop = min(end, run * bs, entry.size)
+                        with memoryview(entry.mm) as view:
+                            buf[start - offset:stop - offset] = \
+                                view[start:stop]
+                        hits += run - idx
+                        if stop < min(end, run * bs):
+                            return stop - offset
+                        idx = run
+                        continue
+
+                    while run <= last and not entry.has(run):
+                        run += 1
+                    generation = entry.generation
+                    size = entry.size
+
+                start = idx * bs
+                stop = min(run * bs, size)
+                data = fetch(stop - start, start) if stop > start else b''
+                if type(data) is FuseErrno:
+                    return data
+                got = len(data)
+                misses += run - idx
+
+                with entry.lock:
+                    if entry.generation == generation and got:
+                        os.pwrite(entry.fd, data, start)
+                        for i in range(idx, run):
+                            if min((i + 1) * bs, size) <= start + got:
+                                entry.add(i)
+                        entry.dirty = True
+                        used = os.fstat(entry.fd).st_blocks * 512
+
+                stop = min(end, start + got)
+                if stop > offset:
+                    buf[max(offset, start) - offset:stop - offset] = \
+                        data[max(offset, start) - start:stop - start]
+                if start + got < min(run * bs, size):
+                    return max(0, stop - offset)
+                idx = run
+
+            return end - offset
+        finally:
+            self._account(entry, hits, misses, used)
+
+    def _account(self, entry, hits, misses, used):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            if used is not None and entry.name in self._files:
+                self.size += used - entry.used
+                entry.used = used
+                self._evict()
+
+    def _evict(self):
+        while self.size > self.maxbytes:
+            for entry in self._files.values():
+                if not entry.users:
+                    break
+            else:
+                return
+
+            self._drop(entry)
+
+    def _drop(self, entry):
+        'Deletes the unused entry, the caller holding self._lock'
+
+        if entry.users:
+            return
+
+        del self._files[entry.name]
+        self.size -= entry.used
+        with entry.lock:
+            if entry.mm is not None:
+                entry.mm.close()
+            if entry.fd is not None:
+                os.close(entry.fd)
+            entry.fd = entry.mm = None
+            self._remove(entry.name)
+
+    def invalidate(self, path, start=0, end=None):
+        '''
+        Invalidates the blocks start to end (excluded, or up to the end of the
+        file if None) of path after it was modified through the mount
+        '''
+
+        with self._lock:
+            entry = self._files.get(self._key(path)[1])
+        if entry is None:
+            return
+
+        with entry.lock:
+            if entry.fd is None:
+                return
+            _clear_bits(entry.bitmap, start,
+                        len(entry.bitmap) * 8 if end is None else end)
+            entry.generation += 1
+            entry.stale = entry.dirty = True
+
+    def discard_tree(self, path):
+        'Discards the cached data of path and every path below it'
+
+        key = self._key(path)[0]
+        prefix = key + b'/'
+        with self._lock:
+            for entry in list(self._files.values()):
+                if entry.path != key and not entry.path.startswith(prefix):
+                    continue
+                if not entry.users:
+                    self._drop(entry)
+                    continue
+
+                # In use: forget its blocks so the next use starts afresh
+                with entry.lock:
+                    self._unlink(entry.name + '.idx')
+                    entry.bitmap = bytearray(len(entry.bitmap))
+                    entry.mtime = None
+                    entry.generation += 1
+                    entry.stale = entry.dirty = False
+
+    def flush(self):
+        'Persists the index of every file modified since the last flush'
+
+        with self._lock:
+            entries = list(self._files.values())
+
+        for entry in entries:
+            with entry.lock:
+                if entry.dirty and entry.fd is not None and \
+                        entry.mtime is not None:
+                    self._write_index(entry)
+
+    def flush_due(self):
+        'Calls flush if sync_interval seconds passed since the last time'
+
+        now = _monotonic()
+        with self._lock:
+            if now < self._next_sync:
+                return
+            self._next_sync = now + self.sync_interval
+        self.flush()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            for entry in self._files.values():
+                with entry.lock:
+                    if entry.mm is not None:
+                        entry.mm.close()
+                    if entry.fd is not None:
+                        os.close(entry.fd)
+                    entry.fd = entry.mm = None
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        hit_rate=_hit_rate(self.hits, self.misses),
+                        files=len(self._files), size=self.size)
+
+
+class DiskBlockCacheMixIn(object):
+    '''
+    Caches the data returned by read in blocks of disk_cache_block bytes in
+    sparse files under disk_cache_dir, which must be set. Hits are copied from
+    a mapping of the cache file straight into the kernel buffer by read_into.
+    The least recently used files are deleted once the cache takes more than
+    disk_cache_size bytes on disk.
+
+    The indexes of the blocks of the files are persisted on unmount, and when
+    a file is released at most every disk_cache_sync_interval seconds, after
+    their data is synced, so that the cache stays warm across mounts. A
+    cached file is validated against the size and mtime returned by getattr
+    the first time it is read after mounting.
+
+    write, fallocate, truncate, create, unlink and rename through this mount
+    invalidate the affected blocks; write_buf of the operations below is not
+    used, as for BlockCacheMixIn, which can be put in front of this cache.
+
+    POSIX only, as it relies on os.pread, os.pwrite and st_blocks.
+    '''
+
+    disk_cache_dir = None
+    disk_cache_block = 1024 * 1024
+    disk_cache_size = 10 * 1024 ** 3
+    disk_cache_sync_interval = 60.0
+
+    _disk_cache_lock = Lock()
+
+    @property
+    def disk_cache(self):
+        try:
+            return self.__dict__['_disk_cache']
+        except KeyError:
+            with self._disk_cache_lock:
+                if '_disk_cache' not in self.__dict__:
+                    self.__dict__['_disk_cache'] = _DiskCache(
+                        self.disk_cache_dir, self.disk_cache_block,
+                        self.disk_cache_size, self.disk_cache_sync_interval,
+                        getattr(self.fuse_instance, 'encoding', 'utf-8'))
+                return self.__dict__['_disk_cache']
+
+    def disk_cache_stats(self):
+        '''
+        Returns a dict with the block hits, misses and hit rate of the cache,
+        and the number of files and bytes it holds on disk
+        '''
+
+        return self.disk_cache.stats()
+
+    def _disk_cache_stat(self, path):
+        try:
+            attrs = _resolve(self, self.getattr(path))
+        except FuseOSError:
+            return None
+        if type(attrs) is FuseErrno:
+            return None
+
+        st = c_stat()
+        use_ns = getattr(self.fuse_instance, 'use_ns', False)
+        set_st_attrs(st, attrs, use_ns=use_ns)
+        if not S_ISREG(st.st_mode):
+            return None
+        return st.st_size, (st.st_mtimespec.tv_sec, st.st_mtimespec.tv_nsec)
+
+    def _disk_cache_fetch(self, path, size, offset, fh):
+        read_into = super(DiskBlockCacheMixIn, self).read_into
+        if read_into is not None:
+            buf = bytearray(size)
+            ret = _resolve(self, read_into(path, memoryview(buf), offset, fh))
+            if type(ret) is FuseErrno:
+                return ret
+            return bytes(buf[:ret or 0])
+
+        data = _resolve(self, super(DiskBlockCacheMixIn, self).read(
+            path, size, offset, fh))
+        if isinstance(data, FileRegion):
+            return os.pread(data.fd, min(data.length, size), data.offset)
+        return data or b''
+
+    def read_into(self, path, buf, offset, fh):
+        return self._disk_cache_read(path, buf, offset, fh)
+
+    def _disk_cache_read(self, path, buf, offset, fh):
+        entry = None
+        if path is not None:
+            entry = self.disk_cache.acquire(
+                path, lambda: self._disk_cache_stat(path))
+
+        if entry is None:
+            data = self._disk_cache_fetch(path, len(buf), offset, fh)
+            if type(data) is FuseErrno:
+                return data
+            buf[:len(data)] = data
+            return len(data)
+
+        try:
+            return self.disk_cache.read_into(
+                entry, buf, offset,
+                lambda size, offset: self._disk_cache_fetch(path, size,
+                                                            offset, fh))
+        finally:
+            self.disk_cache.release(entry)
+
+    def read(self, path, size, offset, fh):
+        buf = bytearray(size)
+        ret = self._disk_cache_read(path, memoryview(buf), offset, fh)
+        if type(ret) is FuseErrno:
+            return ret
+        return bytes(buf[:ret])
+
+    def _invalidate_disk_blocks(self, path, offset=0, length=None):
+        if path is None:
+            return
+
+        bs = self.disk_cache_block
+        end = None if length is None else (offset + length + bs - 1) // bs
+        self.disk_cache.invalidate(path, offset // bs, end)
+
+    def create(self, path, mode, *args):
+        try:
+            return _resolve(self, super(DiskBlockCacheMixIn, self).create(
+                path, mode, *args))
+        finally:
+            self.disk_cache.discard_tree(path)
+
+    @property
+    def fallocate(self):
+        fallocate = super(DiskBlockCacheMixIn, self).fallocate
+        if fallocate is None:
+            return None
+
+        def invalidating(path, mode, offset, length, fh):
+            try:
+                return _resolve(self,
+                                fallocate(path, mode, offset, length, fh))
+            finally:
+                self._invalidate_disk_blocks(path, offset, length)
+
+        return invalidating
+
+    def destroy(self, path):
+        try:
+            return _resolve(self, super(DiskBlockCacheMixIn, self).destroy(
+                path))
+        finally:
+            if '_disk_cache' in self.__dict__:
+                self.disk_cache.close()
+
+    def release(self, path, fh):
+        try:
+            return _resolve(self, super(DiskBlockCacheMixIn, self).release(
+                path, fh))
+        finally:
+            if '_disk_cache' in self.__dict__:
+                self.disk_cache.flush_due()
+
+    def rename(self, old, new):
+        try:
+            return _resolve(self, super(DiskBlockCacheMixIn, self).rename(
+                old, new))
+        finally:
+            self.disk_cache.discard_tree(old)
+            self.disk_cache.discard_tree(new)
+
+    def truncate(self, path, length, fh=None):
+        try:
+            return _resolve(self, super(DiskBlockCacheMixIn, self).truncate(
+                path, length, fh))
+        finally:
+            self._invalidate_disk_blocks(path, length)
+
+    def unlink(self, path):
+        try:
+            return _resolve(self, super(DiskBlockCacheMixIn, self).unlink(
+                path))
+        finally:
+            self.disk_cache.discard_tree(path)
+
+    def write(self, path, data, offset, fh):
+        try:
+            return _resolve(self, super(DiskBlockCacheMixIn, self).write(
+                path, data, offset, fh))
+        finally:
+            self._invalidate_disk_blocks(path, offset, len(data))
+
+    # See BlockCacheMixIn.write_buf
+    write_buf = None
@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+'''
+Benchmarks the FUSE callbacks of an Operations class in-process, without
+mounting anything.
+
+The callbacks are called through the same ctypes function pointers libfuse
+would call, so the results include the marshalling done by fuse.py as well as
+the time spent in the operations themselves. Only needs ctypes, not libfuse or
+/dev/fuse.
+
+    python fusebench.py [-n COUNT] [scenario ...]
+    python fusebench.py --operations mymodule:MyOperations --root /some/dir
+
+It also replays traces recorded with FUSE(..., trace=path), either against an
+Operations class in-process or against a mounted filesystem:
+
+    python fusebench.py --replay TRACE [--operations mymodule:MyOperations]
+    python fusebench.py --replay TRACE --mountpoint /mnt/fs [--realtime]
+'''
+
+from __future__ import print_function, absolute_import, division
+
+import ctypes
+import errno
+import os
+import random
+import time
+
+from importlib import import_module
+from stat import S_IFDIR, S_IFREG
+
+from fuse import (FUSE, FuseOSError, Operations, AsyncOperations,
+                  c_off_t, c_stat, fuse_file_info, read_trace)
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+
+class Result(object):
+    'Number of calls and their latencies in seconds for one scenario'
+
+    def __init__(self, name, latencies):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.elapsed = sum(latencies)
+
+    @property
+    def count(self):
+        return len(self.latencies)
+
+    @property
+    def ops_per_sec(self):
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, p):
+        'Returns the latency below which p percent of the calls completed'
+
+        if not self.latencies:
+            return 0.0
+        idx = min(int(len(self.latencies) * p / 100), len(self.latencies) - 1)
+        return self.latencies[idx]
+
+    def __str__(self):
+        return '%-18s %9d ops %12.0f ops/s   p50 %8.1fus  p90 %8.1fus  ' \
+               'p99 %8.1fus  max %8.1fus' % (
+                   self.name, self.count, self.ops_per_sec,
+                   self.percentile(50) * 1e6, self.percentile(90) * 1e6,
+                   self.percentile(99) * 1e6, self.latencies[-1] * 1e6
+                   if self.latencies else 0.0)
+
+
+_filler_t = ctypes.CFUNCTYPE(
+    ctypes.c_int, ctypes.c_voidp, ctypes.c_char_p, ctypes.POINTER(c_stat),
+    c_off_t)
+
+
+class Bench(object):
+    '''
+    Drives the ctypes callbacks FUSE would register for operations. Takes
+    the same keyword options as FUSE, except mount options.
+
+    The methods call one callback each, take paths as str and return what
+    the callback returned to libfuse (0 or a byte count on success, a
+    negative errno on failure).
+    '''
+
+    def __init__(self, operations, **options):
+        self.operations = operations
+        self.fuse = FUSE.__new__(FUSE)
+        self.fuse._setup(operations, **options)
+        self.ops = self.fuse._fuse_operations()
+        self.encoding = self.fuse.encoding
+
+        self._stat = c_stat()
+        self._fi = fuse_file_info()
+        self._entries = 0
+        self._filler = _filler_t(self._fill)
+
+    def __enter__(self):
+        if isinstance(self.operations, AsyncOperations):
+            self.operations.start_loop()
+        return self
+
+    def __exit__(self, *exc_info):
+        if isinstance(self.operations, AsyncOperations):
+            self.operations.stop_loop()
+
+    def _fill(self, buf, name, st, offset):
+        self._entries += 1
+        return 0
+
+    def _path(self, path):
+        return path.encode(self.encoding)
+
+    def getattr(self, path):
+        return self.ops.getattr(self._path(path), ctypes.byref(self._stat))
+
+    def open(self, path, flags=0):
+        self._fi.flags = flags
+        ret = self.ops.open(self._path(path), ctypes.byref(self._fi))
+        return ret if ret < 0 else self._fi.fh
+
+    def release(self, path, fh):
+        self._fi.fh = fh
+        return self.ops.release(self._path(path), ctypes.byref(self._fi))
+
+    def read(self, path, buf, size, offset, fh):
+        self._fi.fh = fh
+        return self.ops.read(self._path(path),
+                             ctypes.cast(buf, ctypes.POINTER(ctypes.c_byte)),
+                             size, offset, ctypes.byref(self._fi))
+
+    def write(self, path, buf, size, offset, fh):
+        self._fi.fh = fh
+        return self.ops.write(self._path(path),
+                              ctypes.cast(buf, ctypes.POINTER(ctypes.c_byte)),
+                              size, offset, ctypes.byref(self._fi))
+
+    def readdir(self, path):
+        'Returns the number of entries listed, or a negative errno'
+
+        path = self._path(path)
+        fi = self._fi
+        fi.fh = 0
+        if self.ops.opendir:
+            ret = self.ops.opendir(path, ctypes.byref(fi))
+            if ret < 0:
+                return ret
+
+        self._entries = 0
+        try:
+            ret = self.ops.readdir(path, None, self._filler, 0,
+                                   ctypes.byref(fi))
+        finally:
+            if self.ops.releasedir:
+                self.ops.releasedir(path, ctypes.byref(fi))
+        return ret if ret < 0 else self._entries
+
+    def getxattr(self, path, name, buf, size):
+        'Queries the size of the attribute and fetches it, like the kernel'
+
+        path = self._path(path)
+        name = self._path(name)
+        ret = self.ops.getxattr(path, name, None, 0)
+        if ret < 0:
+            return ret
+        return self.ops.getxattr(
+            path, name, ctypes.cast(buf, ctypes.POINTER(ctypes.c_byte)), size)
+
+
+def measure(name, call, args):
+    'Calls call(*a) for every a in args, failing on a negative errno'
+
+    latencies = []
+    append = latencies.append
+    for a in args:
+        start = _clock()
+        ret = call(*a)
+        append(_clock() - start)
+        if ret < 0:
+            raise FuseOSError(-ret)
+    return Result(name, latencies)
+
+
+def stat_storm(bench, root, count):
+    'getattr on the files of root, over and over'
+
+    paths = ['%s/file%d' % (root.rstrip('/'), i % 1000) for i in range(count)]
+    return measure('stat storm', bench.getattr, [(p,) for p in paths])
+
+
+def large_readdir(bench, root, count):
+    'Full listings of root'
+
+    return measure('large readdir', bench.readdir,
+                   [(root,)] * max(count // 1000, 10))
+
+
+def sequential_read(bench, root, count, size=128 * 1024):
+    'Sequential 128 KiB reads of the big file in root'
+
+    path = '%s/big' % root.rstrip('/')
+    fh = bench.open(path)
+    buf = ctypes.create_string_buffer(size)
+    bench.getattr(path)
+    filesize = max(bench._stat.st_size, size)
+    args = [(path, buf, size, (i * size) % filesize, fh)
+            for i in range(count // 10)]
+    try:
+        return measure('sequential read', bench.read, args)
+    finally:
+        bench.release(path, fh)
+
+
+def random_write(bench, root, count, size=4096):
+    'Small writes at random offsets of the big file in root'
+
+    path = '%s/big' % root.rstrip('/')
+    fh = bench.open(path)
+    buf = ctypes.create_string_buffer(b'x' * size, size)
+    bench.getattr(path)
+    blocks = max(bench._stat.st_size // size, 1)
+    rand = random.Random(0)
+    args = [(path, buf, size, rand.randrange(blocks) * size, fh)
+            for i in range(count // 10)]
+    try:
+        return measure('random write', bench.write, args)
+    finally:
+        bench.release(path, fh)
+
+
+def getxattr_storm(bench, root, count):
+    'Size query and fetch of an extended attribute of the files of root'
+
+    buf = ctypes.create_string_buffer(4096)
+    args = [('%s/file%d' % (root.rstrip('/'), i % 1000), 'user.bench', buf,
+             4096) for i in range(count)]
+    return measure('getxattr', bench.getxattr, args)
+
+
+SCENARIOS = (
+    ('stat', stat_storm),
+    ('readdir', large_readdir),
+    ('read', sequential_read),
+    ('write', random_write),
+    ('getxattr', getxattr_storm),
+)
+
+
+class BenchOperations(Operations):
+    '''
+    Minimal in-memory filesystem the scenarios run against by default: a root
+    directory with small files named file0, file1, ... and a 16 MiB file named
+    big.
+    '''
+
+    use_ns = True
+
+    def __init__(self, files=1000, big=16 * 1024 * 1024):
+        now = time.time()
+        self.dir = dict(st_mode=(S_IFDIR | 0o755), st_nlink=2, st_atime=now,
+                        st_mtime=now, st_ctime=now)
+        self.file = dict(st_mode=(S_IFREG | 0o644), st_nlink=1, st_size=64,
+                         st_atime=now, st_mtime=now, st_ctime=now)
+        self.names = ['file%d' % i for i in range(files)]
+        self.files = set('/' + name for name in self.names)
+        self.data = bytearray(big)
+
+    def getattr(self, path, fh=None):
+        if path == '/':
+            return self.dir
+        if path == '/big':
+            return dict(self.file, st_size=len(self.data))
+        if path in self.files:
+            return self.file
+        raise FuseOSError(errno.ENOENT)
+
+    def getxattr(self, path, name, position=0):
+        if name == 'user.bench':
+            return b'value'
+        raise FuseOSError(errno.ENODATA)
+
+    def read(self, path, size, offset, fh):
+        return bytes(self.data[offset:offset + size])
+
+    def readdir(self, path, fh):
+        return ['.', '..', 'big'] + self.names
+
+    def write(self, path, data, offset, fh):
+        self.data[offset:offset + len(data)] = data
+        return len(data)
+
+
+def _zeros(size, _cache={}):
+    try:
+        return _cache[size]
+    except KeyError:
+        return _cache.setdefault(size, b'\x00' * size)
+
+
+class _OperationsTarget(object):
+    'Replays trace records by calling an Operations instance'
+
+    def __init__(self, operations, encoding='utf-8'):
+        self.operations = operations
+        self.encoding = encoding
+        self.handles = {}
+
+    def _fh(self, record):
+        return self.handles.get(record.fh, record.fh)
+
+    def _opened(self, record, ret):
+        self.handles[record.result] = getattr(ret, 'fh', ret)
+
+    def __call__(self, record):
+        ops = self.operations
+        op = record.op
+        path = record.path and record.path.decode(self.encoding)
+        path2 = record.path2 and record.path2.decode(self.encoding)
+        a, b = record.a, record.b
+
+        if op in ('open', 'create'):
+            self._opened(record, ops(op, path, a))
+        elif op == 'opendir':
+            self._opened(record, ops(op, path))
+        elif op in ('read', 'read_into'):
+            ops('read', path, a, b, self._fh(record))
+        elif op == 'write':
+            ops(op, path, _zeros(a), b, self._fh(record))
+        elif op == 'readdir':
+            for entry in ops(op, path, self._fh(record)):
+                pass
+        elif op in ('release', 'releasedir'):
+            ops(op, path, self._fh(record))
+            self.handles.pop(record.fh, None)
+        elif op == 'flush':
+            ops(op, path, self._fh(record))
+        elif op in ('fsync', 'fsyncdir'):
+            ops(op, path, a, self._fh(record))
+        elif op == 'getattr':
+            ops(op, path, self._fh(record) if record.fh else None)
+        elif op == 'truncate':
+            ops(op, path, a, self._fh(record) if record.fh else None)
+        elif op in ('access', 'chmod', 'mkdir'):
+            ops(op, path, a)
+        elif op in ('chown', 'mknod'):
+            ops(op, path, a, b)
+        elif op in ('link', 'rename', 'symlink', 'getxattr', 'removexattr'):
+            ops(op, path, path2)
+        elif op == 'setxattr':
+            ops(op, path, path2, _zeros(a), b)
+        elif op in ('listxattr', 'readlink', 'rmdir', 'statfs', 'unlink',
+                    'utimens'):
+            ops(op, path)
+        else:
+            return False
+        return True
+
+
+class _MountTarget(object):
+    'Replays trace records with system calls on a mounted filesystem'
+
+    def __init__(self, mountpoint):
+        self.mountpoint = os.fsencode(mountpoint)
+        self.fds = {}
+
+    def _path(self, path):
+        return os.path.join(self.mountpoint, path.lstrip(b'/'))
+
+    def _fd(self, record, path):
+        fd = self.fds.get(record.fh)
+        if fd is None:
+            # opened before the trace started
+            fd = self.fds[record.fh] = os.open(path, os.O_RDWR)
+        return fd
+
+    def __call__(self, record):
+        op = record.op
+        if not record.path:
+            return False
+        path = self._path(record.path)
+        a, b = record.a, record.b
+
+        if op == 'open':
+            self.fds[record.result] = os.open(path, a)
+        elif op == 'create':
+            self.fds[record.result] = os.open(
+                path, os.O_CREAT | os.O_RDWR, a & 0o7777)
+        elif op in ('read', 'read_into'):
+            os.pread(self._fd(record, path), a, b)
+        elif op == 'write':
+            os.pwrite(self._fd(record, path), _zeros(a), b)
+        elif op == 'release':
+            fd = self.fds.pop(record.fh, None)
+            if fd is not None:
+                os.close(fd)
+        elif op == 'fsync':
+            os.fsync(self._fd(record, path))
+        elif op == 'getattr':
+            os.lstat(path)
+        elif op == 'readdir':
+            os.listdir(path)
+        elif op == 'truncate':
+            os.truncate(path, a)
+        elif op == 'access':
+            os.access(path, a)
+        elif op == 'chmod':
+            os.chmod(path, a & 0o7777)
+        elif op == 'chown':
+            os.lchown(path, a, b)
+        elif op == 'mkdir':
+            os.mkdir(path, a & 0o7777)
+        elif op == 'mknod':
+            os.mknod(path, a, b)
+        elif op in ('readlink', 'rmdir', 'unlink'):
+            getattr(os, op)(path)
+        elif op == 'statfs':
+            os.statvfs(path)
+        elif op == 'utimens':
+            os.utime(path, None)
+        elif op == 'rename':
+            os.rename(path, self._path(record.path2))
+        elif op == 'link':
+            os.link(self._path(record.path2), path)
+        elif op == 'symlink':
+            os.symlink(record.path2, path)
+        elif op == 'getxattr':
+            os.getxattr(path, record.path2, follow_symlinks=False)
+        elif op == 'listxattr':
+            os.listxattr(path, follow_symlinks=False)
+        elif op == 'setxattr':
+            os.setxattr(path, record.path2, _zeros(a), b,
+                        follow_symlinks=False)
+        elif op == 'removexattr':
+            os.removexattr(path, record.path2, follow_symlinks=False)
+        else:
+            return False
+        return True
+
+
+def replay(records, target, realtime=False, encoding='utf-8'):
+    '''
+    Replays trace records (see fuse.read_trace) against target, either an
+    Operations instance called in-process or the path of a mounted
+    filesystem, and returns a list of Results, one per operation.
+
+    Records are replayed one at a time in the order they started, as fast as
+    possible or, if realtime is set, no earlier than they originally started.
+    The data of writes and xattrs is not recorded, zeros are written instead.
+    Operations which failed are counted like the others.
+    '''
+
+    if isinstance(target, Operations):
+        call = _OperationsTarget(target, encoding)
+    else:
+        call = _MountTarget(target)
+
+    latencies = {}
+    records = sorted(records, key=lambda record: record.start)
+    replay_start = _clock()
+    trace_start = records[0].start if records else 0
+
+    for record in records:
+        if realtime:
+            delay = (record.start - trace_start) - (_clock() - replay_start)
+            if delay > 0:
+                time.sleep(delay)
+
+        start = _clock()
+        try:
+            replayed = call(record)
+        except OSError:
+            replayed = True
+        if replayed:
+            latencies.setdefault(record.op, []).append(_clock() - start)
+
+    return [Result(op, latencies[op]) for op in sorted(latencies)]
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('scenario', nargs='*',
+                        help='scenarios to run: %s (default: all)' % ', '.join(
+                            name for name, f in SCENARIOS))
+    parser.add_argument('-n', '--count', type=int, default=100000,
+                        help='calls per scenario (divided by 10 for reads '
+                             'and writes and by 1000 for readdir)')
+    parser.add_argument('--operations', metavar='MODULE:CLASS',
+                        help='Operations class to benchmark, constructed '
+                             'without arguments (default: in-memory)')
+    parser.add_argument('--root', default='/',
+                        help='directory holding file0..file999 and big')
+    parser.add_argument('--path-cache-size', type=int, default=0,
+                        help='path_cache_size option of FUSE')
+    parser.add_argument('--replay', metavar='TRACE',
+                        help='replay a trace instead of running scenarios')
+    parser.add_argument('--mountpoint',
+                        help='replay against this mounted filesystem')
+    parser.add_argument('--realtime', action='store_true',
+                        help='replay at the original pace')
+    args = parser.parse_args()
+
+    names = args.scenario or [name for name, f in SCENARIOS]
+    unknown = set(names).difference(name for name, f in SCENARIOS)
+    if unknown:
+        parser.error('unknown scenario: %s' % ', '.join(sorted(unknown)))
+
+    if args.operations:
+        module, cls = args.operations.split(':')
+        operations = getattr(import_module(module), cls)()
+    else:
+        operations = BenchOperations()
+
+    if args.replay:
+        records = list(read_trace(args.replay))
+        if args.mountpoint:
+            results = replay(records, args.mountpoint, args.realtime)
+        else:
+            if isinstance(operations, AsyncOperations):
+                operations.start_loop()
+            try:
+                results = replay(records, operations, args.realtime)
+            finally:
+                if isinstance(operations, AsyncOperations):
+                    operations.stop_loop()
+        for result in results:
+            print(result)
+        return
+
+    with Bench(operations, path_cache_size=args.path_cache_size) as bench:
+        for name, scenario in SCENARIOS:
+            if name in names:
+                print(scenario(bench, args.root, args.count))
+
+
+if __name__ == '__main__':
+    main()
@@ -22,32 +22,60 @@ from ctypes.util import find_library
 from platform import machine, system
 from signal import signal, SIGINT, SIG_DFL
 from stat import S_IFDIR
+from threading import Lock
 
 
 _system = system()
 _machine = machine()
 
-_libfuse_path = os.environ.get('FUSE_LIBRARY_PATH')
-if not _libfuse_path:
-    if _system == 'Darwin':
-        # libfuse dependency
-        _libiconv = ctypes.CDLL(find_library('iconv'), ctypes.RTLD_GLOBAL)
+# Well known names of libfuse, tried before the (slow) find_library
+_LIBFUSE_SONAMES = ('libfuse.so.2', 'libfuse.so')
 
-        _libfuse_path = (find_library('fuse4x') or find_library('osxfuse') or
-                         find_library('fuse'))
-    else:
-        _libfuse_path = find_library('fuse')
+_libfuse_path = None
+_libfuse_lock = Lock()
 
-if not _libfuse_path:
-    raise EnvironmentError('Unable to find libfuse')
-else:
-    _libfuse = ctypes.CDLL(_libfuse_path)
+def _find_libfuse():
+    '''
+    Returns the path of libfuse, which is only looked up on first use so that
+    importing this module stays cheap.
+    '''
+
+    global _libfuse_path, _libiconv
+    with _libfuse_lock:
+        if _libfuse_path:
+            return _libfuse_path
+
+        path = os.environ.get('FUSE_LIBRARY_PATH')
+        if not path:
+            if _system == 'Darwin':
+                # libfuse dependency
+                _libiconv = ctypes.CDLL(find_library('iconv'), ctypes.RTLD_GLOBAL)
+
+                path = (find_library('fuse4x') or find_library('osxfuse') or
+                        find_library('fuse'))
+            else:
+                for soname in _LIBFUSE_SONAMES:
+                    try:
+                        ctypes.CDLL(soname)
+                    except OSError:
+                        continue
+                    path = soname
+                    break
+                else:
+                    path = find_library('fuse')
+
+        if not path:
+            raise EnvironmentError('Unable to find libfuse')
+
+        _libfuse_path = path
+        return path
 
 class LibFUSE(ctypes.CDLL):
     def __init__(self):
+        path = _find_libfuse()
         if _system == 'Darwin':
             self.libiconv = _libiconv
-        super(LibFUSE, self).__init__(_libfuse_path)
+        super(LibFUSE, self).__init__(path)
 
         self.fuse_mount.argtypes = (
             ctypes.c_char_p, ctypes.POINTER(fuse_args))
@@ -63,6 +91,7 @@ class LibFUSE(ctypes.CDLL):
         self.fuse_session_add_chan.argtypes = (
             ctypes.c_void_p, ctypes.c_void_p)
         self.fuse_session_loop.argtypes = (ctypes.c_void_p,)
+        self.fuse_session_loop_mt.argtypes = (ctypes.c_void_p,)
         self.fuse_remove_signal_handlers.argtypes = (ctypes.c_void_p,)
         self.fuse_session_remove_chan.argtypes = (ctypes.c_void_p,)
         self.fuse_session_destroy.argtypes = (ctypes.c_void_p,)
@@ -87,6 +116,11 @@ class LibFUSE(ctypes.CDLL):
             ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t,
             ctypes.c_char_p, c_stat_p, c_off_t)
 
+        self.fuse_lowlevel_notify_inval_inode.argtypes = (
+            ctypes.c_void_p, fuse_ino_t, c_off_t, c_off_t)
+        self.fuse_lowlevel_notify_inval_entry.argtypes = (
+            ctypes.c_void_p, fuse_ino_t, ctypes.c_char_p, ctypes.c_size_t)
+
 class fuse_args(ctypes.Structure):
     _fields_ = [
         ('argc', ctypes.c_int),
@@ -257,6 +291,32 @@ class fuse_file_info(ctypes.Structure):
         ('fh', ctypes.c_uint64),
         ('lock_owner', ctypes.c_uint64)]
 
+class fuse_conn_info(ctypes.Structure):
+    _fields_ = [
+        ('proto_major', ctypes.c_uint),
+        ('proto_minor', ctypes.c_uint),
+        ('async_read', ctypes.c_uint),
+        ('max_write', ctypes.c_uint),
+        ('max_readahead', ctypes.c_uint),
+        ('capable', ctypes.c_uint),
+        ('want', ctypes.c_uint),
+        ('max_background', ctypes.c_uint),
+        ('congestion_threshold', ctypes.c_uint),
+        ('reserved', ctypes.c_uint * 23),
+    ]
+
+FUSE_CAP_ASYNC_READ = 1 << 0
+FUSE_CAP_POSIX_LOCKS = 1 << 1
+FUSE_CAP_ATOMIC_O_TRUNC = 1 << 3
+FUSE_CAP_EXPORT_SUPPORT = 1 << 4
+FUSE_CAP_BIG_WRITES = 1 << 5
+FUSE_CAP_DONT_MASK = 1 << 6
+FUSE_CAP_SPLICE_WRITE = 1 << 7
+FUSE_CAP_SPLICE_MOVE = 1 << 8
+FUSE_CAP_SPLICE_READ = 1 << 9
+FUSE_CAP_FLOCK_LOCKS = 1 << 10
+FUSE_CAP_IOCTL_DIR = 1 << 11
+
 class fuse_ctx(ctypes.Structure):
     _fields_ = [
         ('uid', c_uid_t),
@@ -290,7 +350,8 @@ class fuse_entry_param(ctypes.Structure):
 
 class fuse_lowlevel_ops(ctypes.Structure):
     _fields_ = [
-        ('init', ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p)),
+        ('init', ctypes.CFUNCTYPE(
+            None, ctypes.c_void_p, ctypes.POINTER(fuse_conn_info))),
         ('destroy', ctypes.CFUNCTYPE(None, ctypes.c_void_p)),
 
         ('lookup', ctypes.CFUNCTYPE(
@@ -461,13 +522,52 @@ def dict_to_stat(d, use_ns=False):
             d[key + 'spec'] = c_timespec(sec, nsec)
     return c_stat(**d)
 
+def buffer_view(buf, size, readonly=False):
+    '''
+    Returns a memoryview over size bytes at the ctypes pointer buf.
+
+    memoryview.toreadonly needs Python 3.8; before that a readonly view is
+    taken of a copy of the bytes.
+    '''
+
+    if readonly and not hasattr(memoryview, 'toreadonly'):
+        return memoryview(ctypes.string_at(buf, size))
+
+    array = ctypes.cast(buf, ctypes.POINTER(ctypes.c_ubyte * size)).contents
+    view = memoryview(array).cast('B')
+    return view.toreadonly() if readonly else view
+
 def setattr_mask_to_list(mask):
     return [FUSE_SET_ATTR[i] for i in range(len(FUSE_SET_ATTR)) if mask & (1 << i)]
 
 class FUSELL(object):
     use_ns = False
 
-    def __init__(self, mountpoint, encoding='utf-8'):
+    # Pass write data as a read-only memoryview over the kernel buffer instead
+    # of copying it into a bytes object. The view is only valid until write
+    # returns.
+    write_memoryview = False
+
+    # Answer concurrent identical getattr, readlink and read requests (same
+    # inode and arguments) with a single call of the method, whose reply is
+    # sent to all of them. The methods must reply through the self.reply_*
+    # methods for this to work; requests a reply sent otherwise missed are
+    # handled one by one once the method returns.
+    coalesce = False
+
+    # Requests that modify the filesystem: requests coming in while one is
+    # handled do not join the coalesced requests in flight before it
+    MODIFYING = frozenset((
+        'create', 'link', 'mkdir', 'mknod', 'removexattr', 'rename', 'rmdir',
+        'setattr', 'setxattr', 'symlink', 'unlink', 'write'))
+
+    def __init__(self, mountpoint, encoding='utf-8', multithreaded=False):
+        """Mounts the filesystem at mountpoint and serves it until unmounted
+
+        Requests are handled one at a time unless multithreaded is True, in
+        which case libfuse runs a pool of worker threads (fuse_session_loop_mt)
+        and the methods of this class must be thread safe.
+        """
         if not self.use_ns:
             warnings.warn(
                 'Time as floating point seconds for utimens is deprecated!\n'
@@ -478,12 +578,17 @@ class FUSELL(object):
 
         self.libfuse = LibFUSE()
         self.encoding = encoding
+        self._coalesce_lock = Lock()
+        self._coalesce_groups = {}
+        self._coalesce_leaders = {}
 
         fuse_ops = fuse_lowlevel_ops()
 
         for name, prototype in fuse_lowlevel_ops._fields_:
             method = getattr(self, 'fuse_' + name, None) or getattr(self, name, None)
             if method:
+                if self.coalesce and name in self.MODIFYING:
+                    method = self._modifying(method)
                 setattr(fuse_ops, name, prototype(method))
 
         args = ['fuse']
@@ -493,6 +598,7 @@ class FUSELL(object):
 
         chan = self.libfuse.fuse_mount(mountpoint.encode(encoding), argv)
         assert chan
+        self.chan = chan
 
         session = self.libfuse.fuse_lowlevel_new(
             argv, ctypes.byref(fuse_ops), ctypes.sizeof(fuse_ops), None)
@@ -508,7 +614,10 @@ class FUSELL(object):
 
         self.libfuse.fuse_session_add_chan(session, chan)
 
-        err = self.libfuse.fuse_session_loop(session)
+        if multithreaded:
+            err = self.libfuse.fuse_session_loop_mt(session)
+        else:
+            err = self.libfuse.fuse_session_loop(session)
         assert err == 0
 
         err = self.libfuse.fuse_remove_signal_handlers(session)
@@ -523,8 +632,66 @@ class FUSELL(object):
         self.libfuse.fuse_session_destroy(session)
         self.libfuse.fuse_unmount(mountpoint.encode(encoding), chan)
 
+    def _join(self, req, key):
+        """Returns True if an identical request is in flight, in which case
+        req is answered along with it"""
+        with self._coalesce_lock:
+            group = self._coalesce_groups.get(key)
+            if group is not None:
+                group.append(req)
+                return True
+            group = self._coalesce_groups[key] = [req]
+            self._coalesce_leaders[req] = (key, group)
+            return False
+
+    def _leave(self, req):
+        """Removes the group led by req, returning its requests"""
+        with self._coalesce_lock:
+            key, group = self._coalesce_leaders.pop(req, (None, None))
+            if group is None:
+                return (req,)
+            if self._coalesce_groups.get(key) is group:
+                del self._coalesce_groups[key]
+            return group
+
+    def _requests(self, req):
+        """Returns the requests a reply to req should be sent to"""
+        if not self._coalesce_leaders:
+            return (req,)
+        return self._leave(req)
+
+    def _lead(self, req, method, *args):
+        """Calls method for req, the leader of a group. Requests of the
+        group that its reply did not reach (e.g. because it was sent with
+        self.libfuse.fuse_reply_* directly) are handled one by one."""
+        try:
+            method(req, *args)
+        finally:
+            for follower in self._leave(req)[1:]:
+                method(follower, *args)
+
+    def _close_groups(self):
+        """Stops later requests from joining those in flight, which may
+        answer them with data from before a modification"""
+        if self._coalesce_groups:
+            with self._coalesce_lock:
+                self._coalesce_groups.clear()
+
+    def _modifying(self, method):
+        # Closed before the request is handled and again after it, as its
+        # reply may reach the kernel before the handler returns
+        def modifying(*args):
+            self._close_groups()
+            try:
+                return method(*args)
+            finally:
+                self._close_groups()
+        return modifying
+
     def reply_err(self, req, err):
-        return self.libfuse.fuse_reply_err(req, err)
+        for req in self._requests(req):
+            ret = self.libfuse.fuse_reply_err(req, err)
+        return ret
 
     def reply_none(self, req):
         self.libfuse.fuse_reply_none(req)
@@ -539,12 +706,16 @@ class FUSELL(object):
 
     def reply_attr(self, req, attr, attr_timeout):
         st = dict_to_stat(attr, use_ns=self.use_ns)
-        return self.libfuse.fuse_reply_attr(
-            req, ctypes.byref(st), ctypes.c_double(attr_timeout))
+        for req in self._requests(req):
+            ret = self.libfuse.fuse_reply_attr(
+                req, ctypes.byref(st), ctypes.c_double(attr_timeout))
+        return ret
 
     def reply_readlink(self, req, link):
-        return self.libfuse.fuse_reply_readlink(
-            req, link.encode(self.encoding))
+        link = link.encode(self.encoding)
+        for req in self._requests(req):
+            ret = self.libfuse.fuse_reply_readlink(req, link)
+        return ret
 
     def reply_open(self, req, d):
         fi = fuse_file_info(**d)
@@ -554,7 +725,9 @@ class FUSELL(object):
         return self.libfuse.fuse_reply_write(req, count)
 
     def reply_buf(self, req, buf):
-        return self.libfuse.fuse_reply_buf(req, buf, len(buf))
+        for req in self._requests(req):
+            ret = self.libfuse.fuse_reply_buf(req, buf, len(buf))
+        return ret
 
     def reply_readdir(self, req, size, off, entries):
         bufsize = 0
@@ -586,11 +759,17 @@ class FUSELL(object):
     # If you override the following methods you should reply directly
     # with the self.libfuse.fuse_reply_* methods.
 
+    def fuse_init(self, userdata, conn):
+        self.init(userdata, conn.contents)
+
     def fuse_lookup(self, req, parent, name):
         self.lookup(req, parent, name.decode(self.encoding))
 
     def fuse_getattr(self, req, ino, fi):
-        self.getattr(req, ino, struct_to_dict(fi))
+        if not self.coalesce:
+            return self.getattr(req, ino, struct_to_dict(fi))
+        if not self._join(req, ('getattr', ino)):
+            self._lead(req, self.getattr, ino, struct_to_dict(fi))
 
     def fuse_setattr(self, req, ino, attr, to_set, fi):
         attr_dict = stat_to_dict(attr, use_ns=self.use_ns)
@@ -598,6 +777,12 @@ class FUSELL(object):
         fi_dict = struct_to_dict(fi)
         self.setattr(req, ino, attr_dict, to_set_list, fi_dict)
 
+    def fuse_readlink(self, req, ino):
+        if not self.coalesce:
+            return self.readlink(req, ino)
+        if not self._join(req, ('readlink', ino)):
+            self._lead(req, self.readlink, ino)
+
     def fuse_mknod(self, req, parent, name, mode, rdev):
         self.mknod(req, parent, name.decode(self.encoding), mode, rdev)
 
@@ -623,12 +808,23 @@ class FUSELL(object):
         self.open(req, ino, struct_to_dict(fi))
 
     def fuse_read(self, req, ino, size, off, fi):
-        self.read(req, ino, size, off, fi)
+        if not self.coalesce:
+            return self.read(req, ino, size, off, fi)
+        if not self._join(req, ('read', ino, size, off)):
+            self._lead(req, self.read, ino, size, off, fi)
 
     def fuse_write(self, req, ino, buf, size, off, fi):
-        buf_str = ctypes.string_at(buf, size)
         fi_dict = struct_to_dict(fi)
-        self.write(req, ino, buf_str, off, fi_dict)
+        if not self.write_memoryview:
+            buf_str = ctypes.string_at(buf, size)
+            self.write(req, ino, buf_str, off, fi_dict)
+            return
+
+        view = buffer_view(buf, size, readonly=True)
+        try:
+            self.write(req, ino, view, off, fi_dict)
+        finally:
+            view.release()
 
     def fuse_flush(self, req, ino, fi):
         self.flush(req, ino, struct_to_dict(fi))
@@ -669,6 +865,31 @@ class FUSELL(object):
         ctx = self.libfuse.fuse_req_ctx(req)
         return struct_to_dict(ctx)
 
+    def invalidate_inode(self, ino, offset=0, length=0):
+        """Drop the cached attributes and data of an inode from the kernel
+
+        Only the data from offset on is dropped, up to length bytes or to the
+        end of the file if length is 0. A negative offset keeps all data.
+        May be called from any thread while mounted, but not from within an
+        operation on the same inode.
+        """
+        err = self.libfuse.fuse_lowlevel_notify_inval_inode(
+            self.chan, ino, offset, length)
+        if err < 0 and err != -errno.ENOENT:
+            raise OSError(-err, os.strerror(-err))
+
+    def invalidate_entry(self, parent, name):
+        """Drop the cached lookup of name in the directory parent
+
+        May be called from any thread while mounted, but not from within an
+        operation on the same directory.
+        """
+        name = name.encode(self.encoding)
+        err = self.libfuse.fuse_lowlevel_notify_inval_entry(
+            self.chan, parent, name, len(name))
+        if err < 0 and err != -errno.ENOENT:
+            raise OSError(-err, os.strerror(-err))
+
 
     # Methods to be overridden in subclasses.
     # Reply with the self.reply_* methods.
@@ -676,6 +897,10 @@ class FUSELL(object):
     def init(self, userdata, conn):
         """Initialize filesystem
 
+        conn is the fuse_conn_info negotiated with the kernel. Change its
+        max_write, max_readahead, max_background and want fields to adjust
+        the connection.
+
         There's no reply to this method
         """
         pass
@@ -18,7 +18,7 @@ setup(
     maintainer = 'Terence Honles',
     maintainer_email = 'terence@honles.com',
     license = 'ISC',
-    py_modules=['fuse'],
+    py_modules=['fuse', 'fusebench'],
     url = 'http://github.com/fusepy/fusepy',
 
     classifiers = [